@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""Benchmark find_dup_files.py on synthetic directory trees
+
+Generates reproducible trees (the same --seed gives the same files) and
+runs each duplicate-finding strategy on each in a fresh interpreter,
+reporting wall time, bytes and read() calls made (from /proc/self/io,
+so Linux only) and peak memory. Strategies which disagree about the
+duplicates found are flagged.
+
+Note that file data will usually be in the page cache after the first
+run, so timings reflect CPU and syscall overhead more than disk speed."""
+import argparse
+import filecmp
+import itertools
+import json
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import find_dup_files
+
+######################################################################
+#
+# Synthetic trees
+#
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def copy_file(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copyfile(src, dst)
+
+
+def make_small(top, rng, scale):
+    """Many small files in a flat-ish tree, 10% duplicated"""
+    files = []
+    for i in range(int(5000 * scale)):
+        path = os.path.join(top, f"d{i % 50:02d}", f"f{i:06d}")
+        if files and rng.random() < 0.1:
+            copy_file(rng.choice(files), path)
+        else:
+            write_file(path, rng.randbytes(rng.randrange(4096)))
+        files.append(path)
+
+
+def make_huge(top, rng, scale):
+    """A few large files, two of them identical"""
+    size = int(32 * 1024 * 1024 * scale)
+    for i in range(3):
+        path = os.path.join(top, f"huge{i}")
+        os.makedirs(top, exist_ok=True)
+        with open(path, "wb") as f:
+            for offset in range(0, size, 1024 * 1024):
+                f.write(rng.randbytes(min(1024 * 1024, size - offset)))
+    copy_file(os.path.join(top, "huge0"), os.path.join(top, "copy0"))
+
+
+def make_samesize(top, rng, scale):
+    """Many same-size files differing only in the middle
+
+    These defeat the size and partial hash stages."""
+    size = 64 * 1024
+    base = bytearray(rng.randbytes(size))
+    for i in range(int(2000 * scale)):
+        # A few pairs are identical
+        base[size // 2:size // 2 + 4] = (i // 2 if i < 100 else i).to_bytes(
+            4, "big")
+        write_file(os.path.join(top, f"d{i % 20:02d}", f"f{i:05d}"), base)
+
+
+def make_deep(top, rng, scale):
+    """Deep, narrow hierarchy with a few files per level"""
+    path = top
+    for depth in range(int(100 * scale)):
+        path = os.path.join(path, f"level{depth}")
+        for i in range(3):
+            write_file(os.path.join(path, f"f{i}"),
+                       rng.randbytes(rng.choice([10, 100, 1000])))
+
+
+def make_hardlinks(top, rng, scale):
+    """Files with several hard links each, plus some real copies"""
+    for i in range(int(1000 * scale)):
+        path = os.path.join(top, "orig", f"f{i:05d}")
+        write_file(path, rng.randbytes(8192 + i))
+        for j in range(2):
+            link = os.path.join(top, f"links{j}", f"f{i:05d}")
+            os.makedirs(os.path.dirname(link), exist_ok=True)
+            os.link(path, link)
+        if i % 10 == 0:
+            copy_file(path, os.path.join(top, "copies", f"f{i:05d}"))
+
+
+scenarios = {
+    "small": make_small,
+    "huge": make_huge,
+    "samesize": make_samesize,
+    "deep": make_deep,
+    "hardlinks": make_hardlinks,
+}
+
+######################################################################
+#
+# Strategies, run in a child process
+#
+
+
+def run_staged(top, digest="sha256", jobs=1, cache=None):
+    index = find_dup_files.FileIndex()
+    for dirname, name, st in find_dup_files.scan([top]):
+        index.add(dirname, name, st)
+    return [[path for path, st in group]
+            for digest_value, group in find_dup_files.find_duplicates(
+                index, cache=cache, jobs=jobs, digest=digest)]
+
+
+def run_cached(top, digest="blake2b"):
+    """Run twice with a fresh cache, measuring only the second run"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite")
+        cache = find_dup_files.HashCache(path, digest)
+        run_staged(top, digest=digest, cache=cache)
+        cache.close()
+        cache = find_dup_files.HashCache(path, digest)
+        start = measure()
+        groups = run_staged(top, digest=digest, cache=cache)
+        cache.close()
+        return groups, start
+
+
+def run_pairwise(top):
+    """The original all-pairs filecmp approach, with hard links merged"""
+    files = sorted(os.path.join(dirpath, name)
+                   for dirpath, dirnames, names in os.walk(top)
+                   for name in names)
+    groups = []
+    grouped = set()
+    for a, b in itertools.combinations(files, 2):
+        if b in grouped or not filecmp.cmp(a, b, shallow=False):
+            continue
+        for group in groups:
+            if a in group:
+                group.append(b)
+                break
+        else:
+            groups.append([a, b])
+            grouped.add(a)
+        grouped.add(b)
+    return groups
+
+
+strategies = {
+    "staged-sha256": lambda top: run_staged(top, digest="sha256"),
+    "staged-blake2b": lambda top: run_staged(top, digest="blake2b"),
+    "jobs4": lambda top: run_staged(top, digest="blake2b", jobs=4),
+    "cached": run_cached,
+    "pairwise": run_pairwise,
+}
+
+# The pairwise strategy is only run on trees with at most this many files
+PAIRWISE_LIMIT = 2000
+
+
+def read_proc_io():
+    """Return dict of /proc/self/io counters, or {} if unavailable"""
+    try:
+        with open("/proc/self/io") as f:
+            return {k: int(v) for k, v in
+                    (line.split(": ") for line in f)}
+    except OSError:
+        return {}
+
+
+def measure():
+    """Return snapshot of wall time and I/O counters"""
+    return (time.perf_counter(), read_proc_io())
+
+
+def run_child(strategy, top):
+    """Run strategy on top and print JSON results"""
+    start = measure()
+    result = strategies[strategy](top)
+    if strategy == "cached":
+        result, start = result
+    end = time.perf_counter()
+    io = read_proc_io()
+    groups = sorted(sorted(os.path.relpath(p, top) for p in group)
+                    for group in result)
+    # Hard links to one inode are not duplicates for find_dup_files
+    groups = [g for g in groups
+              if len({os.stat(os.path.join(top, p)).st_ino for p in g}) > 1]
+    print(json.dumps({
+        "time": end - start[0],
+        "bytes": io.get("rchar", 0) - start[1].get("rchar", 0) if io else None,
+        "reads": io.get("syscr", 0) - start[1].get("syscr", 0) if io else None,
+        "maxrss": find_dup_files.peak_memory(),
+        "groups": groups,
+    }))
+    return(0)
+
+######################################################################
+
+
+def make_argparser():
+    """Return arparse.ArgumentParser instance"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,  # printed with -h/--help
+        # Don't mess with format of description
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        # To have --help print defaults with trade-off it changes
+        # formatting, use: ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--version", action="version", version="%(prog)s 1.0")
+    parser.add_argument("-s", "--scenario", action="append",
+                        choices=sorted(scenarios),
+                        help="Scenario to run (default all)")
+    parser.add_argument("-S", "--strategy", action="append",
+                        choices=sorted(strategies),
+                        help="Strategy to run (default all)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Scale number and size of files (default 1.0)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for tree generation (default 0)")
+    parser.add_argument("--repeat", type=int, default=1, metavar="N",
+                        help="Run each strategy N times and report the"
+                        " fastest (default 1)")
+    parser.add_argument("--dir", metavar="PATH", default=None,
+                        help="Directory for generated trees"
+                        " (default is a temporary directory)")
+    parser.add_argument("--child", nargs=2, metavar=("STRATEGY", "TREE"),
+                        help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    parser = make_argparser()
+    args = parser.parse_args(argv if argv else sys.argv[1:])
+    if args.child:
+        return run_child(*args.child)
+
+    tmpdir = None
+    if args.dir is None:
+        tmpdir = tempfile.TemporaryDirectory(prefix="bench-find-dup-files")
+        args.dir = tmpdir.name
+    status = 0
+    print(f"{'scenario':10} {'strategy':15} {'files':>7} {'time':>9}"
+          f" {'read':>12} {'reads':>8} {'maxrss':>8} {'groups':>6}")
+    try:
+        for scenario in args.scenario or scenarios:
+            top = os.path.join(args.dir, f"{scenario}-{args.seed}-{args.scale}")
+            if not os.path.exists(top):
+                scenarios[scenario](top, random.Random(args.seed), args.scale)
+            nfiles = sum(len(names) for _, _, names in os.walk(top))
+            reference = None
+            for strategy in args.strategy or strategies:
+                if strategy == "pairwise" and nfiles > PAIRWISE_LIMIT:
+                    continue
+                runs = []
+                for _ in range(args.repeat):
+                    child = subprocess.run(
+                        [sys.executable, os.path.abspath(__file__),
+                         "--child", strategy, top],
+                        stdout=subprocess.PIPE, check=True)
+                    runs.append(json.loads(child.stdout))
+                result = min(runs, key=lambda r: r["time"])
+                if reference is None:
+                    reference = result["groups"]
+                mismatch = result["groups"] != reference
+                if mismatch:
+                    status = 1
+                print(f"{scenario:10} {strategy:15} {nfiles:7d}"
+                      f" {result['time']:8.3f}s"
+                      f" {result['bytes'] or 0:12d} {result['reads'] or 0:8d}"
+                      f" {result['maxrss'] // (1024 * 1024):6d}MB"
+                      f" {len(result['groups']):6d}"
+                      + ("  MISMATCH" if mismatch else ""))
+    finally:
+        if tmpdir:
+            tmpdir.cleanup()
+    return(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
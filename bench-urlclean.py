@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Benchmark urlclean.py and check its output
+
+Generates a reproducible corpus of URLs (the same --seed gives the same
+URLs) of several kinds: plain, tracking-heavy, wrapped in (nested)
+redirectors, with long queries and with unicode hosts. Reports URLs per
+second for each kind and the time taken by each cleanup function and
+each built-in rule.
+
+Before timing, a fixed set of URLs is cleaned and compared with the
+expected results, and with --check the output for the whole corpus is
+compared with that saved earlier with --save, so an optimization can be
+checked to leave output unchanged. Exits with status 1 on any mismatch."""
+import argparse
+import os.path
+import random
+import string
+import sys
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import urlclean
+
+######################################################################
+#
+# Golden results
+#
+
+golden = [
+    ("https://en.wikipedia.org/wiki/Python_(programming_language)",
+     "https://en.wikipedia.org/wiki/Python_(programming_language)"),
+    ("https://www.google.com/url?sa=t&rct=j&q=&esrc=s&source=web&cd=1"
+     "&url=https%3A%2F%2Fen.wikipedia.org%2Fwiki%2FMain_Page&usg=AFQj",
+     "https://en.wikipedia.org/wiki/Main_Page"),
+    ("https://www.google.com/url?q=https://example.com/event&sa=D",
+     "https://example.com/event"),
+    ("https://www.google.com/url?q=notaurl",
+     "https://www.google.com/url?q=notaurl"),
+    ("https://docs.google.com/document/d/1YLZ/edit#heading=h.6puqf6utazmp",
+     "https://docs.google.com/document/d/1YLZ/edit"),
+    ("https://docs.google.com/document/d/1YLZ/edit#other",
+     "https://docs.google.com/document/d/1YLZ/edit#other"),
+    ("http://www.example.com/p/?utm_source=Tips&utm_medium=email"
+     "&utm_campaign=x",
+     "http://www.example.com/p/"),
+    ("https://example.com/?id=1&fbclid=IwAR0&gclid=x&mc_eid=y&dm_i=z",
+     "https://example.com/?id=1"),
+    ("https://example.com/?a=1&b=&c=3",
+     "https://example.com/?a=1&b=&c=3"),
+    ("https://l.facebook.com/l.php?u=https%3A%2F%2Fexample.com%2F%3Fid%3D1"
+     "%26utm_source%3Dfb&h=AT0",
+     "https://example.com/?id=1"),
+    ("https://nam12.safelinks.protection.outlook.com/?url=https%3A%2F%2F"
+     "l.facebook.com%2Fl.php%3Fu%3Dhttps%253A%252F%252Fexample.com%252F"
+     "&data=05",
+     "https://example.com/"),
+    ("https://t.co/abc123",
+     "https://t.co/abc123"),
+    ("https://bücher.example/ä?utm_term=x&q=ü",
+     "https://bücher.example/ä?q=%C3%BC"),
+]
+
+######################################################################
+#
+# Synthetic corpus
+#
+
+
+def random_word(rng, length=None):
+    return "".join(rng.choice(string.ascii_lowercase)
+                   for _ in range(length or rng.randrange(3, 10)))
+
+
+def random_host(rng):
+    return "www." + random_word(rng) + rng.choice([".com", ".org", ".net"])
+
+
+def random_url(rng, params=2):
+    path = "/".join(random_word(rng) for _ in range(rng.randrange(1, 4)))
+    query = urllib.parse.urlencode([(random_word(rng), random_word(rng))
+                                    for _ in range(params)])
+    return f"https://{random_host(rng)}/{path}" + (f"?{query}" if query
+                                                   else "")
+
+
+def make_plain(rng):
+    return random_url(rng, params=rng.randrange(3))
+
+
+def make_tracking(rng):
+    url = random_url(rng, params=1)
+    tracking = [("utm_source", "newsletter"), ("utm_medium", "email"),
+                ("utm_campaign", random_word(rng)), ("fbclid", "IwAR" +
+                random_word(rng, 20)), ("gclid", random_word(rng, 30)),
+                ("mc_eid", random_word(rng, 10))]
+    rng.shuffle(tracking)
+    return url + "&" + urllib.parse.urlencode(
+        tracking[:rng.randrange(1, len(tracking))])
+
+
+redirectors = [
+    "https://www.google.com/url?sa=t&source=web&url={}&usg=AOvVaw",
+    "https://l.facebook.com/l.php?u={}&h=AT0",
+    "https://nam12.safelinks.protection.outlook.com/?url={}&data=05"
+    "&sdata=x&reserved=0",
+    "https://www.youtube.com/redirect?event=video&q={}",
+]
+
+
+def make_redirect(rng):
+    url = rng.choice([make_plain, make_tracking])(rng)
+    for _ in range(rng.randrange(1, 4)):
+        url = rng.choice(redirectors).format(
+            urllib.parse.quote(url, safe=""))
+    return url
+
+
+def make_long_query(rng):
+    return random_url(rng, params=rng.randrange(20, 60)) + \
+        rng.choice(["", "&utm_source=x"])
+
+
+def make_unicode(rng):
+    host = rng.choice(["bücher", "пример",
+                       "例え", "xn--bcher-kva"]) + ".example"
+    return (f"https://{host}/ä/{random_word(rng)}"
+            f"?q=ü{random_word(rng)}"
+            + rng.choice(["", "&utm_medium=social"]))
+
+
+kinds = {
+    "plain": make_plain,
+    "tracking": make_tracking,
+    "redirect": make_redirect,
+    "long-query": make_long_query,
+    "unicode": make_unicode,
+}
+
+
+def make_corpus(seed, count):
+    """Return dict of kind to list of count URLs"""
+    rng = random.Random(seed)
+    return {kind: [make(rng) for _ in range(count)]
+            for kind, make in kinds.items()}
+
+######################################################################
+#
+# Checks and timing
+#
+
+
+def check_golden():
+    """Check golden URLs, return number of mismatches"""
+    mismatches = 0
+    for url, expected in golden:
+        result = urlclean.process_url(url)
+        if result != expected:
+            print(f"MISMATCH {url}\n  expected {expected}\n  got      {result}",
+                  file=sys.stderr)
+            mismatches += 1
+    return mismatches
+
+
+def time_calls(func, urls, repeat):
+    """Return fastest time to call func on each of urls"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for url in urls:
+            func(url)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_function(func, urls, repeat):
+    """Return fastest time to apply cleanup function func to each of urls"""
+    best = None
+    for _ in range(repeat):
+        parsed = [urlclean.URL(url) for url in urls]
+        start = time.perf_counter()
+        for url in parsed:
+            func(url)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def rate(count, elapsed):
+    return count / elapsed if elapsed else 0
+
+######################################################################
+
+
+def make_argparser():
+    """Return arparse.ArgumentParser instance"""
+    parser = argparse.ArgumentParser(
+        description=__doc__,  # printed with -h/--help
+        # Don't mess with format of description
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        # To have --help print defaults with trade-off it changes
+        # formatting, use: ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--version", action="version", version="%(prog)s 1.0")
+    parser.add_argument("-k", "--kind", action="append",
+                        choices=sorted(kinds),
+                        help="Kind of URL to time (default all)")
+    parser.add_argument("--count", type=int, default=10000, metavar="N",
+                        help="Number of URLs of each kind (default 10000)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for corpus generation (default 0)")
+    parser.add_argument("--repeat", type=int, default=3, metavar="N",
+                        help="Time each N times and report the fastest"
+                        " (default 3)")
+    parser.add_argument("--save", metavar="FILE",
+                        help="Write cleaned corpus to FILE")
+    parser.add_argument("--check", metavar="FILE",
+                        help="Compare cleaned corpus with FILE written"
+                        " earlier by --save")
+    return parser
+
+
+def main(argv=None):
+    parser = make_argparser()
+    args = parser.parse_args(argv if argv else sys.argv[1:])
+
+    status = 0
+    if check_golden():
+        status = 1
+
+    corpus = make_corpus(args.seed, args.count)
+    all_urls = [url for kind in kinds for url in corpus[kind]]
+    if args.save or args.check:
+        output = "".join(urlclean.process_url(url) + "\n" for url in all_urls)
+        if args.save:
+            with open(args.save, "w") as f:
+                f.write(output)
+        if args.check:
+            with open(args.check) as f:
+                expected = f.read()
+            if output != expected:
+                for url, got, want in zip(all_urls, output.splitlines(),
+                                          expected.splitlines()):
+                    if got != want:
+                        print(f"MISMATCH {url}\n  expected {want}\n"
+                              f"  got      {got}", file=sys.stderr)
+                        break
+                print(f"Output differs from {args.check}", file=sys.stderr)
+                status = 1
+
+    print(f"{'kind':12} {'process_url':>14} {'clean_url':>14}")
+    for kind in args.kind or kinds:
+        urls = corpus[kind]
+        uncached = time_calls(urlclean.process_url, urls, args.repeat)
+        # Cache hits after the first repeat, as for repeated URLs in logs
+        urlclean.clean_url.cache_clear()
+        urls = urls[:urlclean.CLEAN_URL_CACHE_SIZE]
+        cached = time_calls(urlclean.clean_url, urls, args.repeat)
+        print(f"{kind:12} {rate(len(corpus[kind]), uncached):10.0f}/s"
+              f" {rate(len(urls), cached):10.0f}/s")
+
+    print()
+    print(f"{'function or rule':50} {'time':>9}")
+    for func in urlclean.cleanup_functions:
+        elapsed = time_function(func, all_urls, args.repeat)
+        print(f"{func.__name__:50} {elapsed:8.3f}s")
+    # An empty set of rules gives the cost, e.g. of parsing the query,
+    # common to all rules
+    rules = None
+    for line in [""] + urlclean.DEFAULT_RULES.splitlines():
+        if line.startswith("#") or (not line and rules is not None):
+            continue
+        rules = urlclean.Rules(line)
+        elapsed = time_function(rules.apply, all_urls, args.repeat)
+        print(f"  {line or '(no rules)':48} {elapsed:8.3f}s")
+    return(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
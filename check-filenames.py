@@ -1,9 +1,87 @@
 #!/usr/bin/env python3
-"""Check filenames for unicode, leading/trailing whitespace, etc."""
+"""Check filenames for unicode, leading/trailing whitespace, etc.
+
+Each filename is checked against a set of rules, each a regular
+expression, which are combined into a single pattern so a name is
+scanned once however many rules there are. Additional rules can be read
+from a file (--rules) with one rule per line: a name, whitespace and a
+regular expression. Blank lines and lines starting with '#' are ignored.
+
+Names in the same directory which are equal after Unicode normalization
+and case folding are reported as a Collision, since they would clash
+when synced to a filesystem which normalizes or ignores case (e.g. an
+NFD name from macOS next to its NFC form, or "README" and "Readme").
+
+With --jobs, directories are listed concurrently, which helps a lot on
+network filesystems where each listing costs a round trip. Output is then
+in the order directories are listed unless --ordered is given.
+
+Results for each directory are cached, keyed by its device, inode and
+modification time, so later runs only list and check directories which
+have changed (a directory's mtime changes when entries are added,
+removed or renamed in it). Use --full to check everything.
+
+With --fix, a rename plan is computed for the whole tree: names are
+NFC-normalized (or transliterated to ASCII with --transliterate),
+control, shell and Windows-forbidden characters replaced by '_',
+leading/trailing whitespace and trailing dots removed and reserved
+Windows names prefixed with '_'. New names which would collide with
+another name in the directory get a numeric suffix. The plan is applied
+deepest first and every rename is recorded in a journal, which --undo
+replays in reverse. Use -n to only print the plan.
+
+Problems are printed as they are found, by default as "Rule: path"
+lines. --format json prints one JSON object per problem followed by a
+summary object; -0 prints the rule and paths of each problem terminated
+by NULs, with an empty field ending each problem. --stats prints the
+summary (entries and directories scanned, problems by rule and
+directories per second) to stderr."""
 import argparse
+import collections
+import concurrent.futures
+import functools
 import itertools
+import json
 import os
+import re
+import sqlite3
 import sys
+import time
+import unicodedata
+
+# Default rules, as name: regular expression matching a problem in a
+# filename. Order sets the order issues are reported.
+default_rules = {
+    "Whitespace": r"^\s|\s$",
+    "Non-ascii": r"[^\x00-\x7f]",
+    "Control": r"[\x00-\x1f\x7f]",
+    "Trailing-dot": r"\.$",
+    "Reserved": r"(?i:^(?:CON|PRN|AUX|NUL|COM[1-9]|LPT[1-9])(?:\.[^.]*)?$)",
+    "Shell": r"[`$;|&<>*?!\"'\\]",
+}
+
+# Longest filename, in bytes, allowed by most filesystems
+MAX_NAME_BYTES = 255
+
+# Default for --max-path, the PATH_MAX of macOS
+DEFAULT_MAX_PATH = 1024
+
+# Default location of the directory cache
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "check-filenames", "dirs.sqlite")
+
+# Characters replaced by '_' when fixing names: control characters,
+# characters special to shells and those forbidden on Windows
+FIX_TABLE = {c: "_" for c in itertools.chain(
+    range(0x20), [0x7f], map(ord, "`$;|&<>*?!\"'\\:/"))}
+
+# Matches names reserved on Windows
+RESERVED_NAME = re.compile(default_rules["Reserved"])
+
+# Directories modified this recently are not cached, as they may change
+# again without their mtime changing
+CACHE_MIN_AGE_NS = 2 * 1000 * 1000 * 1000
 
 
 def make_argparser():
@@ -24,26 +102,550 @@ def make_argparser():
                                  action="store_true", default=False,
                                  help="run quietly")
     parser.add_argument("--version", action="version", version="%(prog)s 1.0")
-    parser.add_argument("path", metavar="path", type=str,
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="Number of directories to list concurrently"
+                        " (default 1)")
+    parser.add_argument("-o", "--ordered",
+                        action="store_true", default=False,
+                        help="Check entries in a deterministic order"
+                        " (breadth-first, sorted by name)")
+    parser.add_argument("-r", "--rules", metavar="FILE",
+                        action="append", default=[],
+                        help="Read additional rules from FILE")
+    parser.add_argument("-x", "--skip", metavar="RULE",
+                        action="append", default=[],
+                        help="Do not apply RULE (may be given multiple times)")
+    parser.add_argument("--max-path", type=int, default=DEFAULT_MAX_PATH,
+                        metavar="BYTES",
+                        help="Report paths longer than BYTES"
+                        f" (default {DEFAULT_MAX_PATH})")
+    parser.add_argument("--cache", metavar="PATH", default=DEFAULT_CACHE_PATH,
+                        help="Directory cache"
+                        f" (default is {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--no-cache", dest="cache",
+                        action="store_const", const=None,
+                        help="Do not use a directory cache")
+    parser.add_argument("-F", "--full",
+                        action="store_true", default=False,
+                        help="Check all directories, ignoring cached results")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS),
+                        default="text",
+                        help="Output format (default text)")
+    parser.add_argument("-0", "--null", dest="format",
+                        action="store_const", const="nul",
+                        help="Same as --format nul")
+    parser.add_argument("--stats",
+                        action="store_true", default=False,
+                        help="Print summary statistics to stderr when done")
+    parser.add_argument("--fix",
+                        action="store_true", default=False,
+                        help="Rename files to fix problems")
+    parser.add_argument("-n", "--dry-run",
+                        action="store_true", default=False,
+                        help="With --fix, only print planned renames")
+    parser.add_argument("--transliterate",
+                        action="store_true", default=False,
+                        help="With --fix, convert names to ASCII")
+    parser.add_argument("--journal", metavar="FILE", default=None,
+                        help="With --fix, journal file to record renames in"
+                        " (default is in the cache directory)")
+    parser.add_argument("--undo", metavar="JOURNAL", default=None,
+                        help="Undo the renames recorded in JOURNAL")
+    parser.add_argument("path", metavar="path", type=str, nargs="?",
                         default=os.path.curdir,
                         help="Path to check (default is current directory)")
     return parser
 
 
+def read_rules(path):
+    """Return dict of rules read from the given file"""
+    rules = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            name, pattern = line.split(None, 1)
+            rules[name] = pattern
+    return rules
+
+
+def compile_rules(rules):
+    """Return function returning names of rules matching a filename
+
+    The rules are combined into one regular expression, so each filename
+    is scanned once. Only names which match it, usually few, are then
+    checked against each rule to find which ones they break."""
+    names = list(rules)
+    if not names:
+        return lambda filename: []
+    regex = re.compile("|".join(f"(?:{pattern})"
+                                for pattern in rules.values()))
+    regexes = [re.compile(pattern) for pattern in rules.values()]
+
+    def check(filename):
+        if not regex.search(filename):
+            return []
+        return [name for name, rule in zip(names, regexes)
+                if rule.search(filename)]
+    return check
+
+
+def check_lengths(filename, path, max_path):
+    """Return names of length rules broken by filename and path"""
+    problems = []
+    if len(os.fsencode(filename)) > MAX_NAME_BYTES:
+        problems.append("Long-name")
+    if len(os.fsencode(path)) > max_path:
+        problems.append("Long-path")
+    return problems
+
+
+def collision_key(filename):
+    """Return filename normalized for canonical caseless comparison"""
+    if filename.isascii():
+        return filename.lower()
+    return unicodedata.normalize(
+        "NFD", unicodedata.normalize("NFD", filename).casefold())
+
+
+def find_collisions(names):
+    """Return list of groups of names which collide when normalized"""
+    index = collections.defaultdict(list)
+    for name in names:
+        index[collision_key(name)].append(name)
+    return [sorted(group) for group in index.values() if len(group) > 1]
+
+
+def check_dir(root, names, check, max_path=DEFAULT_MAX_PATH, skipped=()):
+    """Return list of problems found in directory root with given names
+
+    Each problem is a (rule, paths) tuple. check is a function returned
+    by compile_rules(). Rules named in skipped are not reported."""
+    problems = []
+    # Path length doesn't depend on how root was given
+    abs_root = os.path.abspath(root)
+    for name in names:
+        path = os.path.join(root, name)
+        for rule in check(name) + check_lengths(
+                name, os.path.join(abs_root, name), max_path):
+            if rule not in skipped:
+                problems.append((rule, (path,)))
+    if "Collision" not in skipped:
+        for group in find_collisions(names):
+            problems.append(("Collision",
+                             tuple(os.path.join(root, n) for n in group)))
+    return problems
+
+
+def fix_name(name, transliterate=False):
+    """Return name with problems fixed"""
+    if transliterate:
+        name = "".join(c for c in unicodedata.normalize("NFKD", name)
+                       if not unicodedata.combining(c))
+        name = name.encode("ascii", "ignore").decode("ascii")
+    else:
+        name = unicodedata.normalize("NFC", name)
+    # Strip first, so trailing tabs and newlines aren't replaced by '_'
+    name = name.strip().translate(FIX_TABLE).rstrip(". ")
+    if RESERVED_NAME.search(name):
+        name = "_" + name
+    return name or "_"
+
+
+def with_suffix(name, n):
+    """Return name with _n inserted before its extension"""
+    base, ext = os.path.splitext(name)
+    return f"{base}_{n}{ext}"
+
+
+def plan_dir(root, names, transliterate=False):
+    """Return list of (root, old name, new name) renames for directory
+
+    New names never collide, after normalization and case folding, with
+    each other or with any current name, so renames can be applied in
+    any order. Names which already collide are renamed apart."""
+    taken = set()
+    renames = []
+    for name in sorted(names):
+        new = fix_name(name, transliterate)
+        if new == name and collision_key(name) not in taken:
+            taken.add(collision_key(name))
+        else:
+            renames.append((name, new))
+    # Keep new names clear of every current name, other than the one
+    # being renamed, so e.g. an NFD name can become its NFC form
+    current = collections.Counter(collision_key(name) for name in names)
+    plan = []
+    for name, new in renames:
+        own = collision_key(name)
+        candidate = new
+        n = 1
+        while (collision_key(candidate) in taken or
+               current[collision_key(candidate)] >
+               (collision_key(candidate) == own)):
+            n += 1
+            candidate = with_suffix(new, n)
+        taken.add(collision_key(candidate))
+        plan.append((root, name, candidate))
+    return plan
+
+
+def apply_plan(plan, journal, output=print):
+    """Apply renames in plan, deepest directories first
+
+    Each rename is recorded in journal, an open file, as a JSON line.
+    Returns number of renames which failed."""
+    errors = 0
+    for root, old, new in sorted(plan, key=lambda r: r[0].count(os.sep),
+                                 reverse=True):
+        src = os.path.join(root, old)
+        dst = os.path.join(root, new)
+        # On a normalizing or case-insensitive filesystem dst may be src
+        if os.path.lexists(dst) and not os.path.samestat(
+                os.lstat(src), os.lstat(dst)):
+            print(f"Error: {dst} already exists", file=sys.stderr)
+            errors += 1
+            continue
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            errors += 1
+            continue
+        journal.write(json.dumps({"dir": os.path.abspath(root),
+                                  "old": old, "new": new}) + "\n")
+        journal.flush()
+        output(f"Renamed: {src} -> {dst}")
+    return errors
+
+
+def undo_journal(path, output=print):
+    """Undo renames recorded in journal at path, most recent first
+
+    Returns number of renames which failed."""
+    with open(path) as f:
+        renames = [json.loads(line) for line in f if line.strip()]
+    errors = 0
+    for rename in reversed(renames):
+        src = os.path.join(rename["dir"], rename["new"])
+        dst = os.path.join(rename["dir"], rename["old"])
+        # On a normalizing or case-insensitive filesystem dst may be src
+        if os.path.lexists(dst) and not os.path.samestat(
+                os.lstat(src), os.lstat(dst)):
+            print(f"Error: {dst} already exists", file=sys.stderr)
+            errors += 1
+            continue
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            errors += 1
+            continue
+        output(f"Restored: {dst}")
+    return errors
+
+
+def fix_tree(args, output=print):
+    """Plan and apply renames for --fix"""
+    plan = []
+    for root, names, subdirs, key in walk(args.path, jobs=args.jobs,
+                                          ordered=True):
+        plan.extend(plan_dir(root, names, args.transliterate))
+    if args.dry_run:
+        for root, old, new in plan:
+            output("Rename: {} -> {}".format(os.path.join(root, old),
+                                             os.path.join(root, new)))
+        return(0)
+    if not plan:
+        return(0)
+    journal_path = args.journal or os.path.join(
+        os.path.dirname(DEFAULT_CACHE_PATH),
+        time.strftime("journal-%Y%m%d-%H%M%S.jsonl"))
+    dirname = os.path.dirname(journal_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(journal_path, "a") as journal:
+        errors = apply_plan(plan, journal, output=output)
+    output(f"Journal: {journal_path}")
+    return(1 if errors else 0)
+
+
+class DirCache(object):
+    """Persistent cache of problems found in each directory
+
+    Entries are keyed by absolute path, stored as bytes so names which
+    aren't valid UTF-8 can be cached, and hold the directory's
+    (st_dev, st_ino, st_mtime_ns), the names of its subdirectories and
+    the problems found in it. Entries recorded with a different rule
+    configuration are ignored."""
+
+    def __init__(self, path, config):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.config = config
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS dirs (
+            path BLOB PRIMARY KEY, dev INTEGER, ino INTEGER,
+            mtime_ns INTEGER, config TEXT, subdirs TEXT, problems TEXT)""")
+
+    def load(self):
+        """Return dict mapping absolute path to (key, subdirs, problems)
+
+        subdirs is a list of names, problems a list of (rule, names)."""
+        entries = {}
+        for path, dev, ino, mtime_ns, subdirs, problems in self.db.execute(
+                "SELECT path, dev, ino, mtime_ns, subdirs, problems"
+                " FROM dirs WHERE config = ?", (self.config,)):
+            entries[os.fsdecode(path)] = (
+                (dev, ino, mtime_ns), json.loads(subdirs),
+                [(rule, tuple(names))
+                 for rule, names in json.loads(problems)])
+        return entries
+
+    def store(self, path, key, subdirs, problems):
+        """Cache results for directory path"""
+        if time.time_ns() - key[2] < CACHE_MIN_AGE_NS:
+            return
+        self.db.execute(
+            "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (os.fsencode(os.path.abspath(path)),) + key + (
+                self.config,
+                json.dumps([os.path.basename(d) for d in subdirs]),
+                json.dumps([(rule, [os.path.basename(p) for p in paths])
+                            for rule, paths in problems])))
+
+    def delete(self, paths):
+        self.db.executemany("DELETE FROM dirs WHERE path = ?",
+                            ((os.fsencode(p),) for p in paths))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def scan_dir(path, ordered=False, known=None):
+    """Return (path, names, subdirs, key) for the given directory
+
+    names are all entries in the directory, subdirs the paths of those
+    which are directories (not following symbolic links) and key is
+    (st_dev, st_ino, st_mtime_ns) of the directory. If known is a
+    (key, subdir names) tuple and key is unchanged, the directory is not
+    listed and names is None. If the directory can't be listed, key is
+    None so the incomplete results are never cached."""
+    names = []
+    subdirs = []
+    try:
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return (path, names, subdirs, None)
+    if known is not None and known[0] == key:
+        subdirs = [os.path.join(path, d) for d in known[1]]
+        if ordered:
+            subdirs.sort()
+        return (path, None, subdirs, key)
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                names.append(entry.name)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                except OSError:
+                    pass
+    except OSError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        key = None
+    if ordered:
+        names.sort()
+        subdirs.sort()
+    return (path, names, subdirs, key)
+
+
+def walk(top, jobs=1, ordered=False, lookup=lambda path: None):
+    """Yield (dirpath, names, subdirs, key) for top and directories below
+
+    See scan_dir() for the values yielded. lookup(path) returns the
+    known (key, subdir names) of a directory, or None.
+
+    With jobs > 1, directories are listed by a pool of threads, each
+    taking the next queued directory as it becomes free. With ordered,
+    directories are yielded breadth-first and names are sorted, so the
+    order does not depend on jobs."""
+    if jobs <= 1:
+        queue = collections.deque([top])
+        while queue:
+            path = queue.popleft() if ordered else queue.pop()
+            result = scan_dir(path, ordered, lookup(path))
+            subdirs = result[2]
+            queue.extend(subdirs if ordered else reversed(subdirs))
+            yield result
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        def submit(path):
+            return executor.submit(scan_dir, path, ordered, lookup(path))
+
+        if ordered:
+            # Yield in submission order; later directories are listed
+            # concurrently while we wait on the first.
+            queue = collections.deque([submit(top)])
+            while queue:
+                result = queue.popleft().result()
+                queue.extend(submit(d) for d in result[2])
+                yield result
+        else:
+            inflight = {submit(top)}
+            while inflight:
+                done, inflight = concurrent.futures.wait(
+                    inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    inflight.update(submit(d) for d in result[2])
+                    yield result
+
+
+def write_text(rule, paths, out=sys.stdout):
+    print("{}: {}".format(rule, ", ".join(paths)), file=out)
+
+
+def write_json(rule, paths, out=sys.stdout):
+    print(json.dumps({"type": "problem", "rule": rule, "paths": paths}),
+          file=out)
+
+
+def write_nul(rule, paths, out=sys.stdout):
+    fields = [rule.encode()] + [os.fsencode(path) for path in paths]
+    out.buffer.write(b"\0".join(fields) + b"\0\0")
+
+
+OUTPUT_FORMATS = {
+    "text": write_text,
+    "json": write_json,
+    "nul": write_nul,
+}
+
+
+class Stats(object):
+    """Counters for the summary printed by --stats"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.entries = 0
+        self.directories = 0
+        self.unchanged = 0
+        self.problems = collections.Counter()
+
+    def summary(self):
+        """Return summary as a dict"""
+        elapsed = time.monotonic() - self.start
+        return {
+            "entries": self.entries,
+            "directories": self.directories,
+            "unchanged directories": self.unchanged,
+            "problems": dict(self.problems),
+            "seconds": round(elapsed, 3),
+            "directories per second":
+                round(self.directories / elapsed, 1) if elapsed else None,
+        }
+
+
 def main(argv=None):
     parser = make_argparser()
     args = parser.parse_args(argv if argv else sys.argv[1:])
+    write_problem = OUTPUT_FORMATS[args.format]
+    # Keep stdout machine-readable for formats other than text
+    if args.format == "text":
+        output = print
+    else:
+        output = functools.partial(print, file=sys.stderr)
+    debug = output if args.debug else lambda *a, **k: None
+    if args.quiet:
+        output = lambda *a, **k: None
+
+    if args.undo:
+        try:
+            return(1 if undo_journal(args.undo, output=output) else 0)
+        except (OSError, ValueError) as e:
+            print(f"Error reading journal {args.undo}: {e}", file=sys.stderr)
+            return(1)
+    if args.fix:
+        return fix_tree(args, output=output)
+
+    rules = dict(default_rules)
+    for rules_file in args.rules:
+        try:
+            rules.update(read_rules(rules_file))
+        except (OSError, ValueError) as e:
+            print(f"Error reading rules from {rules_file}: {e}",
+                  file=sys.stderr)
+            return(1)
+    for name in args.skip:
+        rules.pop(name, None)
+    try:
+        check = compile_rules(rules)
+    except re.error as e:
+        print(f"Bad rule: {e}", file=sys.stderr)
+        return(1)
+    skipped = set(args.skip)
+
+    cache = None
+    entries = {}
+    if args.cache:
+        config = json.dumps([sorted(rules.items()), args.max_path,
+                             sorted(skipped)])
+        cache = DirCache(args.cache, config)
+        entries = cache.load()
+    known = {} if args.full else entries
+
+    def lookup(path):
+        entry = known.get(os.path.abspath(path))
+        return entry[:2] if entry else None
 
-    for root, dirs, files in os.walk(args.path):
-        for file in itertools.chain(dirs, files):
-            path = os.path.join(root, file)
-            if file != file.strip():
-                print(f"Whitespace: {path}")
-            try:
-                file.encode('ascii')
-            except UnicodeEncodeError:
-                print(f"Non-ascii: {path}")
+    visited = set()
+    stats = Stats()
+    try:
+        for root, names, subdirs, key in walk(args.path, jobs=args.jobs,
+                                              ordered=args.ordered,
+                                              lookup=lookup):
+            if names is None:
+                # Unchanged since last run, replay cached problems
+                debug(f"Unchanged: {root}")
+                stats.unchanged += 1
+                problems = [(rule, tuple(os.path.join(root, n) for n in ns))
+                            for rule, ns in known[os.path.abspath(root)][2]]
+            else:
+                stats.entries += len(names)
+                problems = check_dir(root, names, check,
+                                     max_path=args.max_path, skipped=skipped)
+                if cache and key:
+                    cache.store(root, key, subdirs, problems)
+            visited.add(os.path.abspath(root))
+            stats.directories += 1
+            for rule, paths in problems:
+                stats.problems[rule] += 1
+                write_problem(rule, list(paths))
+            if problems:
+                sys.stdout.flush()
+        if cache:
+            # Forget directories under path which no longer exist
+            top = os.path.abspath(args.path)
+            cache.delete(p for p in entries if p not in visited and
+                         (p == top or p.startswith(os.path.join(top, ""))))
+    finally:
+        if cache:
+            cache.close()
 
+    summary = stats.summary()
+    if args.format == "json":
+        print(json.dumps(dict(type="summary", **summary)))
+    if args.stats:
+        for name, value in summary.items():
+            print(f"{name}: {value}", file=sys.stderr)
     return(0)
 
 
@@ -1,11 +1,107 @@
 #!/usr/bin/env python3
-"""Find and print duplicate (identical) files."""
+"""Find and print duplicate (identical) files.
+
+Files are grouped by size, then by a hash of their first and last
+blocks, and only files which still collide are hashed in full. Each
+set of identical files is printed as soon as it is confirmed, by default
+as one comma-separated line. --format json prints one JSON object per
+line with the size, digest and paths. -0 prints the size, digest and
+each path terminated by a NUL, with an empty field ending each group.
+
+Directories given as arguments (default is the current directory) are
+scanned recursively. Symbolic links are not followed unless -L is given.
+Hard links to the same inode are treated as a single file.
+
+With --watch, the process keeps running and reports new duplicates as
+files are written, moved or deleted, using inotify on Linux and
+periodically rescanning elsewhere.
+
+With --dedupe, duplicates are replaced by hard links or reflinks to a
+single copy. Use -n to report the space that would be reclaimed.
+
+Digests are cached in a SQLite database keyed by device, inode, size
+and modification time, so files which have not changed since the last
+run are not read again. With a non-cryptographic --digest, files with
+matching digests are compared byte for byte before being reported."""
 import argparse
-import filecmp
+import array
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import fcntl
+import fnmatch
+import functools
+import hashlib
 import itertools
+import json
+import mmap
 import os
 import os.path
+import re
+import resource
+import select
+import shutil
+import sqlite3
+import struct
 import sys
+import threading
+import time
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Number of bytes hashed from each end of a file for the partial hash
+PARTIAL_BLOCK_SIZE = 4096
+
+# Size of chunks read when computing a full hash
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Files at least this large are memory-mapped rather than read
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Digest constructors available to --digest
+DIGESTS = {
+    "sha256": hashlib.sha256,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash:
+    DIGESTS["xxh3_128"] = xxhash.xxh3_128
+
+# Digests which are not collision resistant, so matches are verified by
+# comparing file contents
+WEAK_DIGESTS = {"xxh3_128"}
+
+# Limit on the total size of files being hashed concurrently with --jobs
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024
+
+# ioctl to clone a file's extents on Linux (btrfs, XFS, etc.)
+FICLONE = 0x40049409
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE)
+
+# Seconds to wait for more events before checking changed files
+WATCH_SETTLE_TIME = 1.0
+
+# Counters reported by --stats
+stats = collections.Counter()
+
+# Default location of the digest cache
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "find_dup_files", "hashes.sqlite")
 
 
 def make_argparser():
@@ -26,23 +122,982 @@ def make_argparser():
                                  action="store_true", default=False,
                                  help="run quietly")
     parser.add_argument("--version", action="version", version="%(prog)s 1.0")
-    parser.add_argument("files", metavar="files", type=str, nargs="*",
-                        help="Files to check (default is all in current directory")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="Number of files to hash concurrently (default 1)")
+    parser.add_argument("--digest", choices=sorted(DIGESTS),
+                        default="blake2b",
+                        help="Digest used to compare files (default blake2b)")
+    parser.add_argument("--cache", metavar="PATH", default=DEFAULT_CACHE_PATH,
+                        help=f"Digest cache (default is {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--no-cache", dest="cache",
+                        action="store_const", const=None,
+                        help="Do not use a digest cache")
+    parser.add_argument("--prune-cache",
+                        action="store_true", default=False,
+                        help="Remove cache entries for deleted or changed files")
+    parser.add_argument("-e", "--exclude", metavar="GLOB",
+                        action="append", default=[],
+                        help="Skip files and directories whose name or path"
+                        " matches GLOB (may be given multiple times)")
+    parser.add_argument("-L", "--follow-symlinks",
+                        action="store_true", default=False,
+                        help="Follow symbolic links")
+    parser.add_argument("--min-size", type=int, default=0, metavar="BYTES",
+                        help="Ignore files smaller than BYTES")
+    parser.add_argument("--max-size", type=int, default=None, metavar="BYTES",
+                        help="Ignore files larger than BYTES")
+    parser.add_argument("--dedupe", choices=["hardlink", "reflink"],
+                        default=None,
+                        help="Replace duplicates with links to one copy")
+    parser.add_argument("-n", "--dry-run",
+                        action="store_true", default=False,
+                        help="With --dedupe, only report what would be done")
+    parser.add_argument("--format", choices=sorted(OUTPUT_FORMATS),
+                        default="text",
+                        help="Output format (default text)")
+    parser.add_argument("-0", "--null", dest="format",
+                        action="store_const", const="nul",
+                        help="Same as --format nul")
+    parser.add_argument("-w", "--watch",
+                        action="store_true", default=False,
+                        help="Keep running and report new duplicates")
+    parser.add_argument("--interval", type=float, default=60, metavar="SECS",
+                        help="With --watch, seconds between rescans when"
+                        " inotify is unavailable (default 60)")
+    parser.add_argument("--stats",
+                        action="store_true", default=False,
+                        help="Print statistics to stderr when done")
+    parser.add_argument("paths", metavar="paths", type=str, nargs="*",
+                        default=[os.path.curdir],
+                        help="Files and directories to check"
+                        " (default is current directory)")
     return parser
 
 
+class HashCache(object):
+    """Persistent cache of file digests
+
+    Entries are keyed by (st_dev, st_ino) and are only valid while the
+    file's size and st_mtime_ns are unchanged. Each digest algorithm
+    has its own table."""
+
+    def __init__(self, path, digest="sha256"):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.table = f"hashes_{digest}"
+        self.db = sqlite3.connect(path)
+        self.db.execute(f"""CREATE TABLE IF NOT EXISTS {self.table} (
+            dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+            path BLOB, partial BLOB, full BLOB,
+            PRIMARY KEY (dev, ino))""")
+
+    def lookup(self, kind, st):
+        """Return cached digest of given kind for file, or None"""
+        row = self.db.execute(
+            f"SELECT size, mtime_ns, {kind} FROM {self.table}"
+            " WHERE dev = ? AND ino = ?", (st.st_dev, st.st_ino)).fetchone()
+        if row is None:
+            return None
+        if (row[0], row[1]) != (st.st_size, st.st_mtime_ns):
+            # File has changed, so all its digests are stale
+            self.db.execute(
+                f"DELETE FROM {self.table} WHERE dev = ? AND ino = ?",
+                (st.st_dev, st.st_ino))
+            return None
+        return row[2]
+
+    def store(self, kind, path, st, digest):
+        """Cache digest of given kind for file"""
+        self.db.execute(
+            f"INSERT INTO {self.table}"
+            f" (dev, ino, size, mtime_ns, path, {kind})"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (dev, ino) DO UPDATE"
+            f" SET path = excluded.path, {kind} = excluded.{kind}",
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+             # Bytes, as the path may not be valid UTF-8
+             os.fsencode(os.path.abspath(path)), digest))
+
+    def prune(self):
+        """Remove entries for files which no longer exist or have changed
+
+        Returns number of entries removed."""
+        stale = []
+        for dev, ino, size, mtime_ns, path in self.db.execute(
+                f"SELECT dev, ino, size, mtime_ns, path FROM {self.table}"):
+            try:
+                st = os.stat(os.fsdecode(path))
+            except OSError:
+                stale.append((dev, ino))
+                continue
+            if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != \
+                    (dev, ino, size, mtime_ns):
+                stale.append((dev, ino))
+        self.db.executemany(
+            f"DELETE FROM {self.table} WHERE dev = ? AND ino = ?", stale)
+        return len(stale)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+# Per-thread reusable read buffers
+_buffers = threading.local()
+
+
+def read_buffers():
+    """Return this thread's pair of reusable READ_CHUNK_SIZE buffers"""
+    buffers = getattr(_buffers, "buffers", None)
+    if buffers is None:
+        buffers = _buffers.buffers = (bytearray(READ_CHUNK_SIZE),
+                                      bytearray(READ_CHUNK_SIZE))
+    return buffers
+
+
+def partial_hash(path, st, new_digest=hashlib.sha256):
+    """Return digest of the first and last blocks of the given file"""
+    size = st.st_size
+    h = new_digest()
+    with open(path, "rb", buffering=0) as f:
+        h.update(f.read(PARTIAL_BLOCK_SIZE))
+        if size > 2 * PARTIAL_BLOCK_SIZE:
+            f.seek(-PARTIAL_BLOCK_SIZE, os.SEEK_END)
+            h.update(f.read(PARTIAL_BLOCK_SIZE))
+        elif size > PARTIAL_BLOCK_SIZE:
+            h.update(f.read())
+    return h.digest()
+
+
+def full_hash(path, st, new_digest=hashlib.sha256):
+    """Return digest of the full contents of the given file
+
+    Large files are memory-mapped, others are read into a reused buffer,
+    so no per-chunk objects are allocated."""
+    h = new_digest()
+    with open(path, "rb", buffering=0) as f:
+        if st.st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(m)
+            return h.digest()
+        buf = read_buffers()[0]
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.digest()
+
+
+def same_contents(path1, path2):
+    """Return True if the two files have identical contents"""
+    buf1, buf2 = read_buffers()
+    with open(path1, "rb", buffering=0) as f1, \
+            open(path2, "rb", buffering=0) as f2:
+        while True:
+            n1 = f1.readinto(buf1)
+            n2 = f2.readinto(buf2)
+            if n1 != n2:
+                return False
+            # Compare whole buffers without slicing, which would copy
+            # them; comparing memoryviews avoids the copy but is slower
+            if n1 == READ_CHUNK_SIZE:
+                if buf1 != buf2:
+                    return False
+            elif memoryview(buf1)[:n1] != memoryview(buf2)[:n2]:
+                return False
+            if not n1:
+                return True
+
+
+def verify_group(group):
+    """Split group of tuples, each starting with a path, by contents
+
+    Returns list of resulting groups with more than one member."""
+    result = []
+    remaining = list(group)
+    while len(remaining) > 1:
+        first = remaining[0]
+        same = [first]
+        different = []
+        for record in remaining[1:]:
+            try:
+                match = same_contents(first[0], record[0])
+            except OSError as e:
+                print(f"Error reading {record[0]}: {e}", file=sys.stderr)
+                continue
+            (same if match else different).append(record)
+        if len(same) > 1:
+            result.append(same)
+        remaining = different
+    return result
+
+
+def hash_files(positions, index, hashfunc, kind, cache=None, jobs=1,
+               read_size=lambda st: st.st_size):
+    """Yield (j, digest) for each file positions[j] of FileIndex index
+
+    Digests are computed with hashfunc(path, stat), consulting and filling
+    cache if given. With jobs > 1, files are hashed concurrently while
+    keeping the total read_size() of files in flight under
+    MAX_INFLIGHT_BYTES. Files are read in (st_dev, st_ino) order to reduce
+    seeking, and results are yielded in that order regardless of jobs.
+    The digest of a file which cannot be read is None."""
+    todo = array.array("L")
+    for j, i in enumerate(positions):
+        digest = cache.lookup(kind, index.stat(i)) if cache else None
+        if digest is None:
+            todo.append(j)
+        else:
+            yield (j, digest)
+    # The sort key packs st_dev and st_ino into one int, to keep the
+    # temporary list small
+    todo = array.array("L", sorted(
+        todo, key=lambda j: index.dev[positions[j]] << 64 |
+        index.ino[positions[j]]))
+
+    def finish(j, digest_func):
+        path, st = index.record(positions[j])
+        try:
+            digest = digest_func()
+        except OSError as e:
+            print(f"Error reading {path}: {e}", file=sys.stderr)
+            return None
+        stats["files read"] += 1
+        stats["bytes hashed"] += read_size(st)
+        if cache:
+            cache.store(kind, path, st, digest)
+        return digest
+
+    if jobs <= 1:
+        for j in todo:
+            yield (j, finish(j, lambda: hashfunc(*index.record(positions[j]))))
+        return
+
+    def size(j):
+        return read_size(index.stat(positions[j]))
+
+    # SQLite connections may only be used from the main thread, so
+    # workers only hash and results are handled here.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        inflight = {}
+        inflight_bytes = 0
+        # Next entries of todo to submit and to yield; completed results
+        # wait in done_digests for those submitted before them
+        submit = 0
+        next_result = 0
+        done_digests = {}
+        while submit < len(todo) or inflight:
+            while submit < len(todo) and len(inflight) < 2 * jobs and \
+                    (not inflight or
+                     inflight_bytes + size(todo[submit]) <=
+                     MAX_INFLIGHT_BYTES):
+                j = todo[submit]
+                submit += 1
+                future = executor.submit(hashfunc,
+                                         *index.record(positions[j]))
+                inflight[future] = j
+                inflight_bytes += size(j)
+            done, _ = concurrent.futures.wait(
+                inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                j = inflight.pop(future)
+                inflight_bytes -= size(j)
+                done_digests[j] = finish(j, future.result)
+            while next_result < submit and \
+                    todo[next_result] in done_digests:
+                j = todo[next_result]
+                next_result += 1
+                yield (j, done_digests.pop(j))
+
+
+def split_by(groups, index, hashfunc, kind, cache=None, jobs=1,
+             read_size=lambda st: st.st_size, debug=lambda *a, **k: None):
+    """Split each group of positions in FileIndex index by digest
+
+    Groups are arrays of positions. Yields (digest, group) for each
+    resulting group with more than one member, as soon as all members of
+    the original group are hashed. Files which cannot be read are
+    dropped with a warning."""
+    positions = array.array("L")
+    group_of = array.array("L")
+    # Group n is positions[starts[n]:starts[n + 1]]
+    starts = array.array("L", [0])
+    for n, group in enumerate(groups):
+        positions.extend(group)
+        group_of.extend([n] * len(group))
+        starts.append(len(positions))
+    remaining = array.array("L", (len(group) for group in groups))
+    # Digests of files in groups not yet completely hashed
+    digests = [None] * len(positions)
+    count = 0
+    for j, digest in hash_files(positions, index, hashfunc, kind,
+                                cache=cache, jobs=jobs, read_size=read_size):
+        n = group_of[j]
+        digests[j] = digest
+        remaining[n] -= 1
+        if remaining[n] == 0:
+            buckets = collections.defaultdict(
+                functools.partial(array.array, "L"))
+            for k in range(starts[n], starts[n + 1]):
+                if digests[k] is not None:
+                    buckets[digests[k]].append(positions[k])
+                    digests[k] = None
+            for digest, bucket in buckets.items():
+                if len(bucket) > 1:
+                    count += 1
+                    yield (digest, bucket)
+    debug(f"{kind}: {count} candidate groups")
+
+
+def compile_excludes(patterns):
+    """Return function matching a name or path against any of the globs"""
+    if not patterns:
+        return lambda name, path: False
+    regex = re.compile("|".join(fnmatch.translate(p) for p in patterns))
+    return lambda name, path: bool(regex.match(name) or regex.match(path))
+
+
+class FileStat(object):
+    """The subset of os.stat_result used for finding duplicates"""
+
+    __slots__ = ("st_dev", "st_ino", "st_size", "st_mtime_ns", "st_nlink")
+
+    def __init__(self, st_dev, st_ino, st_size, st_mtime_ns, st_nlink):
+        self.st_dev = st_dev
+        self.st_ino = st_ino
+        self.st_size = st_size
+        self.st_mtime_ns = st_mtime_ns
+        self.st_nlink = st_nlink
+
+    @classmethod
+    def from_stat(cls, st):
+        return cls(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                   st.st_nlink)
+
+    def key(self):
+        """Return tuple which changes when the file does"""
+        return (self.st_dev, self.st_ino, self.st_size, self.st_mtime_ns)
+
+
+class FileIndex(object):
+    """Compact, column-oriented index of scanned files
+
+    Each file is stored as a directory number, its name encoded into a
+    shared bytearray and its stat fields in arrays, so an entry costs a
+    few dozen bytes rather than a path string plus an os.stat_result.
+    Files are identified by their position in the index."""
+
+    def __init__(self):
+        self.dirs = []
+        self.dir_numbers = {}
+        self.dir = array.array("L")
+        self.names = bytearray()
+        self.name_offsets = array.array("Q", [0])
+        self.dev = array.array("Q")
+        self.ino = array.array("Q")
+        self.size = array.array("q")
+        self.mtime_ns = array.array("q")
+        self.nlink = array.array("L")
+
+    def __len__(self):
+        return len(self.dir)
+
+    def add(self, dirname, name, st):
+        """Add file name in dirname with given stat result"""
+        number = self.dir_numbers.get(dirname)
+        if number is None:
+            number = self.dir_numbers[dirname] = len(self.dirs)
+            self.dirs.append(dirname)
+        self.dir.append(number)
+        self.names += os.fsencode(name)
+        self.name_offsets.append(len(self.names))
+        self.dev.append(st.st_dev)
+        self.ino.append(st.st_ino)
+        self.size.append(st.st_size)
+        self.mtime_ns.append(st.st_mtime_ns)
+        self.nlink.append(st.st_nlink)
+
+    def path(self, i):
+        """Return path of file i"""
+        name = os.fsdecode(
+            bytes(self.names[self.name_offsets[i]:self.name_offsets[i + 1]]))
+        return os.path.join(self.dirs[self.dir[i]], name)
+
+    def stat(self, i):
+        """Return FileStat for file i"""
+        return FileStat(self.dev[i], self.ino[i], self.size[i],
+                        self.mtime_ns[i], self.nlink[i])
+
+    def record(self, i):
+        """Return (path, stat) tuple for file i"""
+        return (self.path(i), self.stat(i))
+
+    def inode(self, i):
+        """Return (st_dev, st_ino) of file i"""
+        return (self.dev[i], self.ino[i])
+
+
+def scan(paths, excluded=lambda name, path: False, min_size=0,
+         max_size=None, follow_symlinks=False):
+    """Yield (dirname, name, stat) for each regular file under paths
+
+    Directories are walked with os.scandir() and the stat results cached
+    in each DirEntry are used, so each file is stat'ed at most once."""
+    seen_dirs = set()
+
+    def wanted(st):
+        return (st.st_size >= min_size and
+                (max_size is None or st.st_size <= max_size))
+
+    def walk(top):
+        # An explicit stack rather than recursion, so deep trees don't
+        # exceed the recursion limit
+        stack = [top]
+        while stack:
+            top = stack.pop()
+            try:
+                st = os.stat(top)
+            except OSError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                continue
+            # Guard against directory loops via symbolic links
+            if (st.st_dev, st.st_ino) in seen_dirs:
+                continue
+            seen_dirs.add((st.st_dev, st.st_ino))
+            try:
+                with os.scandir(top) as it:
+                    entries = list(it)
+            except OSError as e:
+                print(f"Error: {e}", file=sys.stderr)
+                continue
+            subdirs = []
+            for entry in entries:
+                if excluded(entry.name, entry.path):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=follow_symlinks):
+                        st = entry.stat(follow_symlinks=follow_symlinks)
+                        if wanted(st):
+                            yield (top, entry.name, st)
+                except OSError as e:
+                    print(f"Error: {e}", file=sys.stderr)
+            # Reversed, so subdirectories are walked in listing order
+            stack.extend(reversed(subdirs))
+
+    for path in paths:
+        if os.path.islink(path) and not follow_symlinks:
+            continue
+        if os.path.isdir(path):
+            yield from walk(path)
+            continue
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            continue
+        if wanted(st):
+            yield os.path.split(path) + (st,)
+
+
+def find_duplicates(index, cache=None, jobs=1, digest="sha256",
+                    debug=lambda *a, **k: None):
+    """Yield (digest, group) for each group of identical files
+
+    index is a FileIndex of candidate files, as filled from scan().
+    Each group is a list of (path, stat) tuples sorted by path, and is
+    yielded as soon as it is confirmed. Paths which are hard links to the
+    same inode are treated as one file: it is read once, and a group is
+    only reported if it contains more than one inode. If cache is a
+    HashCache, it is used to avoid rereading files. jobs is the number of
+    files to hash concurrently. digest is a key of DIGESTS."""
+    # Candidates are kept as arrays of positions in the index, and
+    # (path, stat) records only made for files being hashed or reported.
+    counts = collections.Counter(index.size)
+    by_size = {}
+    for i, size in enumerate(index.size):
+        if counts[size] > 1:
+            bucket = by_size.get(size)
+            if bucket is None:
+                bucket = by_size[size] = array.array("L")
+            bucket.append(i)
+    del counts
+    # Within each size, sort by inode so hard links are adjacent, and
+    # keep one position per inode as the candidate group.
+    groups = []
+    for size, bucket in by_size.items():
+        bucket = by_size[size] = array.array(
+            "L", sorted(bucket, key=index.inode))
+        group = array.array("L", (
+            i for n, i in enumerate(bucket)
+            if n == 0 or index.inode(i) != index.inode(bucket[n - 1])))
+        if len(group) > 1:
+            groups.append(group)
+    debug(f"size: {len(groups)} candidate groups")
+    new_digest = DIGESTS[digest]
+
+    def with_links(group):
+        """Return sorted (path, stat) records of group and its hard links"""
+        inodes = {index.inode(i) for i in group}
+        return sorted(index.record(i) for i in by_size[index.size[group[0]]]
+                      if index.inode(i) in inodes)
+
+    def confirmed(digest_value, group):
+        """Yield group, verified if needed, with hard links included"""
+        if digest in WEAK_DIGESTS:
+            records = [(path, st, i) for i in group
+                       for path, st in [index.record(i)]]
+            verified = [array.array("L", (i for path, st, i in g))
+                        for g in verify_group(records)]
+        else:
+            verified = [group]
+        for g in verified:
+            yield (digest_value, with_links(g))
+
+    # Empty files are all identical, no need to read them
+    for group in groups:
+        if index.size[group[0]] == 0:
+            yield from confirmed(new_digest().digest(), group)
+    candidates = [g for g in groups if index.size[g[0]] > 0]
+    del groups
+    large = []
+    for digest_value, group in split_by(
+            candidates, index,
+            functools.partial(partial_hash, new_digest=new_digest),
+            "partial", cache=cache, jobs=jobs,
+            read_size=lambda st: min(st.st_size, 2 * PARTIAL_BLOCK_SIZE),
+            debug=debug):
+        # If the partial hash covered the whole file, it is a full hash
+        if index.size[group[0]] <= 2 * PARTIAL_BLOCK_SIZE:
+            yield from confirmed(digest_value, group)
+        else:
+            large.append(group)
+    del candidates
+    for digest_value, group in split_by(
+            large, index, functools.partial(full_hash, new_digest=new_digest),
+            "full", cache=cache, jobs=jobs, debug=debug):
+        yield from confirmed(digest_value, group)
+
+
+def reflink(src, dst):
+    """Create dst as a copy-on-write clone of src using FICLONE"""
+    with open(src, "rb") as s, open(dst, "xb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def check_unchanged(path, st):
+    """Raise RuntimeError if path has changed since stat st was taken"""
+    current = os.lstat(path)
+    if (current.st_ino, current.st_size, current.st_mtime_ns) != \
+            (st.st_ino, st.st_size, st.st_mtime_ns):
+        raise RuntimeError(f"{path} changed since it was hashed")
+
+
+def replace_with_link(src, dst, st, method, src_st=None):
+    """Replace dst, whose expected stat is st, with a link to src
+
+    method is "hardlink" or "reflink". The replacement is atomic and is
+    skipped if dst, or src if its expected stat src_st is given, has
+    changed since it was hashed."""
+    if src_st is not None:
+        check_unchanged(src, src_st)
+    check_unchanged(dst, st)
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        if method == "reflink":
+            reflink(src, tmp)
+            shutil.copystat(dst, tmp)
+        else:
+            os.link(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def dedupe(group, method, dry_run=False, output=print):
+    """Replace duplicates in group with links to one copy
+
+    Returns the number of bytes reclaimed (or which would be, with
+    dry_run). Space is only counted for inodes all of whose links are
+    in the group."""
+    inodes = collections.defaultdict(list)
+    for path, st in group:
+        inodes[(st.st_dev, st.st_ino)].append((path, st))
+    # Keep the inode with the most links, so fewest paths change
+    master = max(inodes.values(), key=len)
+    master_path, master_st = master[0]
+    reclaimed = 0
+    if not dry_run:
+        # Linking to a master which has changed would lose data
+        try:
+            check_unchanged(master_path, master_st)
+        except (OSError, RuntimeError) as e:
+            print(f"Skipping group: {e}", file=sys.stderr)
+            return reclaimed
+    for links in inodes.values():
+        if links is master:
+            continue
+        st = links[0][1]
+        if st.st_dev != master_st.st_dev:
+            output(f"Skipping {links[0][0]}: on a different device"
+                   f" from {master_path}")
+            continue
+        for path, st in links:
+            if dry_run:
+                output(f"Would {method} {path} -> {master_path}")
+                continue
+            try:
+                replace_with_link(master_path, path, st, method,
+                                  src_st=master_st)
+            except (OSError, RuntimeError) as e:
+                print(f"Error linking {path}: {e}", file=sys.stderr)
+                break
+            output(f"{method}: {path} -> {master_path}")
+        else:
+            if st.st_nlink == len(links):
+                reclaimed += st.st_size
+    return reclaimed
+
+
+class Inotify(object):
+    """Minimal ctypes wrapper around Linux inotify
+
+    Raises OSError or AttributeError if inotify is not available."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Map watch descriptors to directory paths
+        self.watches = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+
+    def remove_watches(self, top):
+        """Remove watches on directory top and directories below it
+
+        Used when top is moved away or deleted, as its watches would
+        otherwise report events under its old path."""
+        prefix = os.path.join(top, "")
+        for wd, path in list(self.watches.items()):
+            if path == top or path.startswith(prefix):
+                # Fails harmlessly if the kernel already removed it
+                self._rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout=None):
+        """Return list of (path, mask) events, waiting up to timeout"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            offset += struct.calcsize("iIII")
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif wd in self.watches:
+                events.append((os.path.join(self.watches[wd],
+                                            os.fsdecode(name)), mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """In-memory index of files kept up to date for --watch
+
+    Calls handle_group(digest, group) for each group of duplicates which
+    includes a new or changed file."""
+
+    def __init__(self, paths, handle_group, cache, jobs=1, digest="sha256",
+                 excluded=lambda name, path: False, min_size=0,
+                 max_size=None, follow_symlinks=False,
+                 debug=lambda *a, **k: None):
+        self.paths = paths
+        self.handle_group = handle_group
+        self.cache = cache
+        self.jobs = jobs
+        self.digest = digest
+        self.excluded = excluded
+        self.min_size = min_size
+        self.max_size = max_size
+        self.follow_symlinks = follow_symlinks
+        self.debug = debug
+        self.files = {}
+        self.by_size = collections.defaultdict(set)
+
+    def scan(self, paths):
+        """Return dict mapping path to FileStat for files under paths"""
+        return {os.path.join(dirname, name): FileStat.from_stat(st)
+                for dirname, name, st in scan(
+                    paths, excluded=self.excluded, min_size=self.min_size,
+                    max_size=self.max_size,
+                    follow_symlinks=self.follow_symlinks)}
+
+    def add(self, path, st):
+        self.remove(path)
+        self.files[path] = st
+        self.by_size[st.st_size].add(path)
+
+    def remove(self, path):
+        st = self.files.pop(path, None)
+        if st is not None:
+            self.by_size[st.st_size].discard(path)
+            if not self.by_size[st.st_size]:
+                del self.by_size[st.st_size]
+
+    def remove_tree(self, top):
+        prefix = os.path.join(top, "")
+        for path in [p for p in self.files if p.startswith(prefix)]:
+            self.remove(path)
+
+    def rescan(self):
+        """Rescan all paths, checking new and changed files"""
+        found = self.scan(self.paths)
+        for path in set(self.files) - set(found):
+            self.remove(path)
+        changed = [path for path, st in found.items()
+                   if path not in self.files or
+                   self.files[path].key() != st.key()]
+        for path in changed:
+            self.add(path, found[path])
+        self.check(changed)
+
+    def update(self, paths):
+        """Recheck given paths, which may be files or directories"""
+        changed = []
+        for path in paths:
+            self.remove_tree(path)
+            self.remove(path)
+            for file_path, st in self.scan([path]).items():
+                self.add(file_path, st)
+                changed.append(file_path)
+        self.check(changed)
+
+    def check(self, changed):
+        """Report groups of duplicates including any of changed paths"""
+        changed = set(changed)
+        if not changed:
+            return
+        self.debug(f"Checking {len(changed)} changed files")
+        index = FileIndex()
+        for size in {self.files[path].st_size for path in changed}:
+            if len(self.by_size[size]) > 1:
+                for path in sorted(self.by_size[size]):
+                    dirname, name = os.path.split(path)
+                    index.add(dirname, name, self.files[path])
+        for digest, group in find_duplicates(index, cache=self.cache,
+                                             jobs=self.jobs,
+                                             digest=self.digest,
+                                             debug=self.debug):
+            if any(path in changed for path, st in group):
+                self.handle_group(digest, group)
+        self.cache.commit()
+
+    def watch_dirs(self, inotify, top):
+        """Add inotify watches on top and directories below it"""
+        for dirpath, dirnames, filenames in os.walk(
+                top, followlinks=self.follow_symlinks):
+            dirnames[:] = [d for d in dirnames
+                           if not self.excluded(d, os.path.join(dirpath, d))]
+            try:
+                inotify.add_watch(dirpath)
+            except OSError as e:
+                print(f"Error watching {dirpath}: {e}", file=sys.stderr)
+
+    def run_inotify(self, inotify):
+        for path in self.paths:
+            if os.path.isdir(path):
+                self.watch_dirs(inotify, path)
+        self.rescan()
+        while True:
+            events = inotify.read()
+            # Let a burst of events settle before checking files
+            while True:
+                more = inotify.read(WATCH_SETTLE_TIME)
+                if not more:
+                    break
+                events.extend(more)
+            changed = set()
+            overflow = False
+            for path, mask in events:
+                if path is None:
+                    overflow = True
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.remove_tree(path)
+                    self.remove(path)
+                    # Forget earlier events for it, e.g. a file written
+                    # and then renamed
+                    prefix = os.path.join(path, "")
+                    changed = {p for p in changed
+                               if p != path and not p.startswith(prefix)}
+                    if mask & IN_ISDIR:
+                        inotify.remove_watches(path)
+                elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_dirs(inotify, path)
+                    changed.add(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    changed.add(path)
+            if overflow:
+                self.debug("inotify queue overflowed, rescanning")
+                self.rescan()
+            else:
+                self.update(changed)
+
+    def run_polling(self, interval):
+        while True:
+            self.rescan()
+            time.sleep(interval)
+
+    def run(self, interval=60):
+        """Report duplicates and then watch for changes forever"""
+        try:
+            inotify = Inotify()
+        except (OSError, AttributeError, TypeError) as e:
+            self.debug(f"inotify unavailable ({e}), rescanning"
+                       f" every {interval} seconds")
+            self.run_polling(interval)
+            return
+        try:
+            self.run_inotify(inotify)
+        finally:
+            inotify.close()
+
+
+def write_text(digest, group, out=sys.stdout):
+    """Write group as a comma-separated line"""
+    print(", ".join(path for path, st in group), file=out, flush=True)
+
+
+def write_json(digest, group, out=sys.stdout):
+    """Write group as a JSON object on one line"""
+    print(json.dumps({"size": group[0][1].st_size,
+                      "digest": digest.hex(),
+                      "paths": [path for path, st in group]}),
+          file=out, flush=True)
+
+
+def write_nul(digest, group, out=sys.stdout):
+    """Write group as NUL-terminated fields ending with an empty field"""
+    fields = [str(group[0][1].st_size).encode(), digest.hex().encode()]
+    fields.extend(os.fsencode(path) for path, st in group)
+    out.buffer.write(b"\0".join(fields) + b"\0\0")
+    out.buffer.flush()
+
+
+OUTPUT_FORMATS = {
+    "text": write_text,
+    "json": write_json,
+    "nul": write_nul,
+}
+
+
+def peak_memory():
+    """Return peak resident set size of this process in bytes"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def print_stats(file=sys.stderr):
+    """Print contents of stats and peak memory usage"""
+    for name in ("files scanned", "files read", "bytes hashed"):
+        print(f"{name}: {stats[name]}", file=file)
+    print(f"peak memory: {peak_memory()} bytes", file=file)
+
+
 def main(argv=None):
     parser = make_argparser()
     args = parser.parse_args(argv if argv else sys.argv[1:])
-    if len(args.files):
-        files = args.files
+    write_group = OUTPUT_FORMATS[args.format]
+    # Keep stdout machine-readable for formats other than text
+    if args.format == "text":
+        output = print
     else:
-        files = filter(lambda f: os.path.isfile(f), os.listdir("."))
+        output = functools.partial(print, file=sys.stderr)
+    debug = output if args.debug else lambda *a, **k: None
+    if args.quiet:
+        output = lambda *a, **k: None
+    excluded = compile_excludes(args.exclude)
+    # In watch mode, always cache digests so unchanged files are not reread
+    if args.watch and not args.cache:
+        args.cache = ":memory:"
+    cache = HashCache(args.cache, args.digest) if args.cache else None
+    reclaimed = 0
+
+    def handle_group(digest, group):
+        nonlocal reclaimed
+        write_group(digest, group)
+        if args.dedupe:
+            reclaimed += dedupe(group, args.dedupe,
+                                dry_run=args.dry_run, output=output)
 
-    for pairs in itertools.combinations(files, 2):
-        if filecmp.cmp(pairs[0], pairs[1]):
-            print(f"{pairs[0]}, {pairs[1]}")
+    try:
+        if cache and args.prune_cache:
+            debug(f"Pruned {cache.prune()} cache entries")
+        if args.watch:
+            watcher = Watcher(args.paths, handle_group, cache,
+                              jobs=args.jobs, digest=args.digest,
+                              excluded=excluded, min_size=args.min_size,
+                              max_size=args.max_size,
+                              follow_symlinks=args.follow_symlinks,
+                              debug=debug)
+            try:
+                watcher.run(interval=args.interval)
+            except KeyboardInterrupt:
+                pass
+        else:
+            index = FileIndex()
+            for dirname, name, st in scan(
+                    args.paths, excluded=excluded,
+                    min_size=args.min_size, max_size=args.max_size,
+                    follow_symlinks=args.follow_symlinks):
+                index.add(dirname, name, st)
+            stats["files scanned"] = len(index)
+            debug(f"Scanned {len(index)} files"
+                  f" in {len(index.dirs)} directories")
+            for digest, group in find_duplicates(index, cache=cache,
+                                                 jobs=args.jobs,
+                                                 digest=args.digest,
+                                                 debug=debug):
+                handle_group(digest, group)
+        if args.dedupe:
+            output("{} {} bytes".format(
+                "Reclaimable:" if args.dry_run else "Reclaimed:", reclaimed))
+    finally:
+        if cache:
+            cache.close()
 
+    if args.stats:
+        print_stats()
     return(0)
 
 
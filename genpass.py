@@ -2,9 +2,11 @@
 """Generate passwords or pass phrases"""
 
 import argparse
+import functools
 import itertools
+import os
 import os.path
-import random
+import secrets
 import string
 import subprocess
 import sys
@@ -17,6 +19,67 @@ debug = print
 def null_output(*args, **kwargs):
     pass
 
+######################################################################
+#
+# Source of randomness
+#
+
+
+class Entropy(object):
+    """Random choices made from blocks of bytes from the secrets module
+
+    Reading random bytes a block at a time, and mapping them to
+    characters with bytes.translate(), makes generating many passwords
+    cheap. Bytes which would make some characters more likely than
+    others are discarded (rejection sampling), so every character of an
+    alphabet is equally likely."""
+
+    def __init__(self, block_size=64 * 1024):
+        self.block_size = block_size
+        self.block = b""
+        self.offset = 0
+        # Cache of alphabet -> (translation table, bytes to delete)
+        self.tables = {}
+
+    def read(self, n):
+        """Return n random bytes"""
+        if self.offset + n > len(self.block):
+            self.block = secrets.token_bytes(max(self.block_size, n))
+            self.offset = 0
+        data = self.block[self.offset:self.offset + n]
+        self.offset += n
+        return data
+
+    def table(self, alphabet):
+        """Return translation table and bytes to delete for alphabet
+
+        Byte b maps to alphabet[b % len(alphabet)], bytes too large for
+        that to be unbiased are deleted."""
+        if alphabet not in self.tables:
+            limit = 256 - 256 % len(alphabet)
+            table = bytes(ord(alphabet[b % len(alphabet)])
+                          for b in range(limit)) + bytes(256 - limit)
+            self.tables[alphabet] = (table, bytes(range(limit, 256)))
+        return self.tables[alphabet]
+
+    def string(self, alphabet, length):
+        """Return string of length random characters from alphabet"""
+        if len(alphabet) > 256 or any(ord(c) > 127 for c in alphabet):
+            return "".join(self.choices(alphabet, length))
+        table, delete = self.table(alphabet)
+        result = b""
+        while len(result) < length:
+            result += self.read(length - len(result)).translate(table, delete)
+        return result.decode("ascii")
+
+    def choices(self, population, k):
+        """Return list of k random elements of population"""
+        return [population[secrets.randbelow(len(population))]
+                for i in range(k)]
+
+
+entropy = Entropy()
+
 ######################################################################
 #
 # Functions to generate different types of passwords/passs phrases
@@ -38,7 +101,7 @@ def pass_word(args):
                 '0O1l'
             ))
     debug("Length is {}".format(args.length))
-    s = "".join([random.choice(alphabet) for i in range(args.length)])
+    s = entropy.string(alphabet, args.length)
     return s
 
 
@@ -57,16 +120,36 @@ def pass_device(args):
                 '0O1l'
             ))
     debug("Length is {}".format(args.length))
-    s = "".join([random.choice(alphabet) for i in range(args.length)])
+    s = entropy.string(alphabet, args.length)
     return s
 
 
 def pass_phrase(args):
     """Generate a pass phrase."""
+    words = read_words(args.dict)
+    debug("Length is {}".format(args.length))
+    # Create lists of random words and random separators
+    words = [word.strip() for word in entropy.choices(words, args.length)]
+    if args.capitalize:
+        words = [str.capitalize(word) for word in words]
+    sep = entropy.choices(separators[args.separator], args.length)
+    # Create list of (word, sep) tuples then chain those lists into a string
+    # Kudos: http://stackoverflow.com/a/2017923/197789
+    # The strip() handles trailing whitespace if separatores are spaces
+    s = "".join(itertools.chain(*zip(words, sep))).strip()
+    return s
+
+
+@functools.lru_cache()
+def read_words(path=None):
+    """Return list of words from path, or a standard place if None
+
+    Cached so a dictionary is only read once when generating many pass
+    phrases."""
     words = None
-    if args.dict:
+    if path:
         # Use user-specified file
-        dict = os.path.expanduser(args.dict)
+        dict = os.path.expanduser(path)
         debug("Reading user-specified dictionary {}".format(dict))
         with open(dict) as f:
             words = f.readlines()
@@ -81,18 +164,7 @@ def pass_phrase(args):
                 continue
         if not words:
             raise FileNotFoundError("No dictionary file found.")
-    debug("Length is {}".format(args.length))
-    # Create lists of random words and random separators
-    words = [random.choice(words).strip() for i in range(args.length)]
-    if args.capitalize:
-        words = [str.capitalize(word) for word in words]
-    sep = [random.choice(separators[args.separator])
-           for i in range(args.length)]
-    # Create list of (word, sep) tuples then chain those lists into a string
-    # Kudos: http://stackoverflow.com/a/2017923/197789
-    # The strip() handles trailing whitespace if separatores are spaces
-    s = "".join(itertools.chain(*zip(words, sep))).strip()
-    return s
+    return words
 
 
 def pass_pin(args):
@@ -100,7 +172,7 @@ def pass_pin(args):
     alphabet = string.digits
     length = args.length
     debug("Length is {}".format(length))
-    s = "".join([random.choice(alphabet) for i in range(length)])
+    s = entropy.string(alphabet, length)
     return s
 
 ######################################################################
@@ -115,6 +187,39 @@ def output_stdout(s, args):
     return(0)
 
 
+def positive_int(value):
+    """argparse type for an integer of at least one"""
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return n
+
+
+def output_many(args):
+    """Generate args.count passwords, writing one per line
+
+    Output is to args.output_file if given, else stdout."""
+    if args.output_file:
+        # Only readable by the user, as it holds passwords
+        f = os.fdopen(os.open(args.output_file,
+                              os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                      "w")
+    else:
+        f = sys.stdout
+    try:
+        for i in range(args.count):
+            f.write(args.function(args) + "\n")
+    finally:
+        if f is not sys.stdout:
+            f.close()
+        else:
+            f.flush()
+    return(0)
+
+
 def output_clipboard(s, args):
     """Output to paste buffer"""
     output("Putting passphrase/word into paste buffer...")
@@ -206,6 +311,15 @@ def main(argv=None):
         action='store_const', const=output_stdout,
         dest='out_function',
         help="Write password to STDOUT")
+    parser.add_argument(
+        "-n", "--count",
+        type=positive_int, default=1, metavar="N",
+        help="Generate N passwords, one per line, to STDOUT or"
+        " --output-file")
+    parser.add_argument(
+        "-o", "--output-file",
+        metavar="PATH",
+        help="Write passwords to PATH (created readable only by you)")
     parser.add_argument("--version", action="version", version="%(prog)s 1.0")
 
     parser_word = subparsers.add_parser('word')
@@ -269,15 +383,23 @@ def main(argv=None):
         help="Specify separator for pass phrase",
         choices=separators.keys())
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv[1:])
 
     global output
     output = print if not args.quiet else null_output
     global debug
     debug = print if args.debug else null_output
 
-    debug("Calling random.seed()")
-    random.seed()
+    if args.count > 1 or args.output_file:
+        # Quieten per-password debugging
+        debug = null_output
+        try:
+            return(output_many(args))
+        except Exception as e:
+            print("Failed:" + str(e))
+            if args.debug:
+                raise e
+            return(1)
 
     try:
         debug("Invoking {}".format(str(args.function)))
@@ -6,137 +6,333 @@ This script docstring serves as a usage message (with -h).
 Kudos: http://www.artima.com/weblogs/viewpost.jsp?thread=4829
 
 Modified to use argparse (new in 2.7) instead of getopt.
+
+Query parameters to remove, redirectors to unwrap and fragments to drop
+are declared as rules (see the Rules class). Rules are read from
+~/.config/urlclean/rules, if it exists, and files given with --rules,
+in addition to the built-in ones. For example:
+
+    param utm_*
+    param ref www.example.com
+    redirect l.facebook.com /l.php u
+    fragment docs.google.com /document/* heading=
+
+With --batch, each line of the given files (or stdin) is cleaned as a
+separate URL and written to stdout in the same order. Lines which aren't
+URLs are written prefixed with "# Bad url: ". Large inputs can be
+cleaned by several processes at once with --jobs, output order is
+unchanged.
+
+With --text, URLs anywhere in the given files (or stdin), e.g. emails,
+Markdown or HTML, are cleaned and everything else is left as it is.
+
+With --watch, urlclean keeps running and cleans each URL copied to the
+clipboard, avoiding starting a process for every URL. On macOS with
+pyobjc installed the pasteboard is checked without running anything,
+wl-clipboard and xclip with clipnotify installed are told when the
+clipboard changes, but the pbpaste backend, and xclip without
+clipnotify, run a command to read the clipboard every --interval
+seconds (86400 a day at the default of one second).
 """
 
 import argparse
+import codecs
+import collections
+import concurrent.futures
 import fileinput
+import fnmatch
+import functools
+import io
+import locale
+import os
+import os.path
+import re
+import select
+import shutil
 import subprocess
 import sys
+import threading
+import time
 import urllib.request
 import urllib.parse
 import urllib.error
 import urllib.parse
 import webbrowser
 
+try:
+    import AppKit
+except ImportError:
+    AppKit = None
+
 # Allow building list of cleanup functions to call using descorator
 cleanup_functions = []
 
 
 def url_cleanup_function(function):
-    """Decorator to make a function a URL clean up function to call."""
+    """Decorator to make a function a URL clean up function to call.
+
+    Clean up functions are passed a URL instance, which they modify in
+    place."""
     cleanup_functions.append(function)
     return function
 
 
-@url_cleanup_function
-def clean_google_redirect(urlstring):
-    """Clean up a Google redirect from search or calendar
+class URL(object):
+    """A URL parsed once and shared by all cleanup functions
+
+    The query is only split into parameters when first needed, and the
+    URL is only reassembled if a cleanup function changed it."""
+
+    def __init__(self, urlstring):
+        self.set(urlstring)
+
+    def set(self, urlstring):
+        """Replace the URL with urlstring (e.g. the target of a redirect)"""
+        self.original = urlstring
+        self.parts = urllib.parse.urlparse(urlstring)
+        self._query_params = None
+        self.modified = False
+
+    def __getattr__(self, name):
+        # scheme, netloc, path, params, query, fragment, hostname, etc.
+        return getattr(self.parts, name)
+
+    def replace(self, **kwargs):
+        """Replace components of the URL as per ParseResult._replace()"""
+        self.parts = self.parts._replace(**kwargs)
+        if "query" in kwargs:
+            self._query_params = None
+        self.modified = True
+
+    @property
+    def query_params(self):
+        """List of (name, value) pairs in the query"""
+        if self._query_params is None:
+            self._query_params = urllib.parse.parse_qsl(
+                self.parts.query, keep_blank_values=True)
+        return self._query_params
+
+    def get_param(self, name):
+        """Return first value of query parameter name, or None"""
+        if not self.parts.query:
+            return None
+        for key, value in self.query_params:
+            if key == name:
+                return value
+        return None
 
-    Google search result:
-        https://www.google.com/url?sa=t&rct=j&q=&esrc=s&source=web&cd=4&ved=0ahUKEwjex5Om3_nQAhXGqVQKHUiHDIoQFggoMAM&url=https%3A%2F%2Fen.wikipedia.org%2Fwiki%2F%2522Hello%2C_World!%2522_program&usg=AFQjCNGfl-sRw62JgahA16FJaZSX9L7oCg&bvm=bv.142059868,d.eWE
-    Converts to:
-        https://en.wikipedia.org/wiki/%22Hello,_World!%22_program
+    def remove_params(self, names):
+        """Remove query parameters whose names are in names"""
+        self.remove_params_if(names.__contains__)
+
+    def remove_params_if(self, predicate):
+        """Remove query parameters for whose names predicate is true"""
+        if not self.parts.query:
+            return
+        params = [(k, v) for k, v in self.query_params if not predicate(k)]
+        if len(params) != len(self.query_params):
+            self.replace(query=urllib.parse.urlencode(params))
+            self._query_params = params
+
+    def geturl(self):
+        """Return URL as a string"""
+        return self.parts.geturl() if self.modified else self.original
+
+
+# Built-in rules, in the format described by Rules.
+DEFAULT_RULES = """
+# Google search result:
+#   https://www.google.com/url?sa=t&...&url=https%3A%2F%2Fen.wikipedia.org...
+# Calendar URLs are similar but use 'q' instead of 'url'
+redirect www.google.com /url url q
+
+# Other redirectors which include the target in the query
+redirect l.facebook.com /l.php u
+redirect lm.facebook.com /l.php u
+redirect safelinks.protection.outlook.com / url
+redirect www.youtube.com /redirect q
+redirect out.reddit.com /* url
+redirect slack-redir.net /link url
+redirect l.instagram.com / u
+redirect www.linkedin.com /redir/redirect url
+
+# Google docs with heading:
+#   https://docs.google.com/document/d/1YLZ.../edit#heading=h.6puqf6utazmp
+fragment docs.google.com /document/* heading=
+
+# Email tracking campaigns, e.g.
+#   http://www.woodsmithtips.com/...?utm_source=WoodsmithTips&utm_medium=email
+param utm_*
+param dm_i
+param fbclid
+param gclid
+param dclid
+param msclkid
+param mc_eid
+param mc_cid
+param _hsenc
+param _hsmi
+"""
 
-    Calendar URLs are similar but use 'q' instead of 'url'
-    """
+# User rules, read in addition to DEFAULT_RULES if present
+DEFAULT_RULES_PATH = os.path.join(
+    os.environ.get("XDG_CONFIG_HOME", os.path.expanduser("~/.config")),
+    "urlclean", "rules")
+
+
+class HostRules(object):
+    """Rules which apply to one host and its subdomains"""
+
+    def __init__(self):
+        # List of (compiled path glob, parameter names)
+        self.redirects = []
+        # List of (compiled path glob, compiled fragment regex)
+        self.fragments = []
+        # List of parameter name globs
+        self.params = []
+
+
+class Rules(object):
+    """Declarative URL cleanup rules
+
+    Rules are given one per line, blank lines and lines starting with '#'
+    are ignored:
+
+        param NAME [HOST]
+            Remove query parameter NAME, which may be a glob (e.g. utm_*),
+            from all URLs, or only from URLs for HOST.
+        redirect HOST PATH PARAM [PARAM...]
+            URLs for HOST whose path matches the glob PATH are replaced
+            by the value of the first PARAM present.
+        fragment HOST PATH REGEX
+            Remove the fragment of URLs for HOST whose path matches the
+            glob PATH and whose fragment matches REGEX.
+
+    A rule for HOST also applies to its subdomains. Host rules are
+    indexed by host name and query parameters are checked against a
+    single set and pattern, so the cost of cleaning a URL depends only
+    on the rules which can match it."""
+
+    def __init__(self, text=""):
+        self.param_names = set()
+        self.param_globs = []
+        self.hosts = {}
+        self.param_regex = None
+        self.load(text)
+
+    def host(self, name):
+        return self.hosts.setdefault(name.lower(), HostRules())
+
+    def load(self, text):
+        """Add rules from the given text"""
+        for lineno, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            try:
+                kind = fields[0]
+                if kind == "param" and len(fields) in (2, 3):
+                    if len(fields) == 3:
+                        self.host(fields[2]).params.append(fields[1])
+                    elif any(c in fields[1] for c in "*?["):
+                        self.param_globs.append(fields[1])
+                    else:
+                        self.param_names.add(fields[1])
+                elif kind == "redirect" and len(fields) >= 4:
+                    self.host(fields[1]).redirects.append(
+                        (compile_glob(fields[2]), fields[3:]))
+                elif kind == "fragment" and len(fields) == 4:
+                    self.host(fields[1]).fragments.append(
+                        (compile_glob(fields[2]), re.compile(fields[3])))
+                else:
+                    raise ValueError(f"bad rule: {line}")
+            except (re.error, ValueError) as e:
+                raise ValueError(f"line {lineno}: {e}")
+        self.param_regex = None
+        if self.param_globs:
+            self.param_regex = re.compile(
+                "|".join(fnmatch.translate(g) for g in self.param_globs))
+
+    def for_host(self, hostname):
+        """Return list of HostRules for hostname, most specific first"""
+        found = []
+        if not hostname:
+            return found
+        labels = hostname.split(".")
+        for i in range(len(labels)):
+            host_rules = self.hosts.get(".".join(labels[i:]))
+            if host_rules:
+                found.append(host_rules)
+        return found
+
+    def drop_param(self, name):
+        """Return True if the global rules remove parameter name"""
+        return (name in self.param_names or
+                (self.param_regex is not None and
+                 self.param_regex.match(name) is not None))
+
+    def redirect_target(self, url, host_rules):
+        """Return target of url if it is a known redirector, else None"""
+        if not url.query:
+            return None
+        for rules in host_rules:
+            for path_regex, params in rules.redirects:
+                if not path_regex.match(url.path):
+                    continue
+                for param in params:
+                    target = url.get_param(param)
+                    # Only follow targets which look like URLs
+                    if target and urllib.parse.urlsplit(target).scheme:
+                        return target
+        return None
 
-    parsed_url = urllib.parse.urlparse(urlstring)
-    if parsed_url.netloc == "www.google.com" and \
-            parsed_url.path == "/url" and \
-            parsed_url.query:
-        query_params = urllib.parse.parse_qs(parsed_url.query)
-        if "url" in query_params:
-            return query_params["url"][0]
-        elif "q" in query_params:
-            return query_params["q"][0]
-    return None
+    def apply(self, url):
+        """Apply rules to a URL instance
 
+        Redirectors are unwrapped repeatedly, as they are often nested
+        (e.g. a Google search result for a Facebook link in an Outlook
+        safelink), up to MAX_REDIRECT_DEPTH times."""
+        host_rules = self.for_host(url.hostname)
+        for _ in range(MAX_REDIRECT_DEPTH):
+            target = self.redirect_target(url, host_rules)
+            if target is None or target == url.geturl():
+                break
+            url.set(target)
+            host_rules = self.for_host(url.hostname)
+        if url.query:
+            host_params = [p for rules in host_rules for p in rules.params]
+            url.remove_params_if(
+                lambda name: self.drop_param(name) or
+                any(fnmatch.fnmatchcase(name, p) for p in host_params))
+        if url.fragment:
+            for rules in host_rules:
+                for path_regex, fragment_regex in rules.fragments:
+                    if path_regex.match(url.path) and \
+                            fragment_regex.match(url.fragment):
+                        url.replace(fragment="")
+                        return
 
-@url_cleanup_function
-def remove_google_docs_heading(urlstring):
-    """Remove headings from Google docs urls
-
-    Google docs with heading:
-        https://docs.google.com/document/d/1YLZzQbY__0HSEDZ6UWO8KgaULu2R1gv0jGI6XWWSh6w/edit#heading=h.6puqf6utazmp
-    Coverts to:
-        https://docs.google.com/document/d/1YLZzQbY__0HSEDZ6UWO8KgaULu2R1gv0jGI6XWWSh6w/edit
-    """
-    parsed_url = urllib.parse.urlparse(urlstring)
-    if parsed_url.netloc == "docs.google.com" and \
-            parsed_url.path.startswith("/document/") and \
-            parsed_url.fragment and \
-            parsed_url.fragment.startswith("heading="):
-        return(parsed_url._replace(fragment="").geturl())
-    return None
 
+# Maximum number of nested redirectors to unwrap
+MAX_REDIRECT_DEPTH = 10
 
-@url_cleanup_function
-def utm_cleaner(urlstring):
-    """Clean UTM fields out of query
+# Number of URLs for which clean_url() remembers the result
+CLEAN_URL_CACHE_SIZE = 16384
 
-    For URLs in email tracking campaigns.
 
-    Woodsmith email tracking URL:
-        http://www.woodsmithtips.com/2016/12/15/our-favorite-shop-materials/?utm_source=WoodsmithTips&utm_medium=email&utm_campaign=11806
-    Converts to:
-        http://www.woodsmithtips.com/2016/12/15/our-favorite-shop-materials/
-    """
-    parsed_url = urllib.parse.urlparse(urlstring)
-    if not parsed_url.query:
-        return None
-    query_params = urllib.parse.parse_qs(parsed_url.query)
-    # Remove elements from dict
-    # kudos: http://stackoverflow.com/a/11277439/197789
-    query_params.pop("utm_source", None)
-    query_params.pop("utm_medium", None)
-    query_params.pop("utm_campaign", None)
-    query = urllib.parse.urlencode(query_params, doseq=True)
-    # Create modified parsed_url using _replace()
-    # Kudos: http://stackoverflow.com/a/24201020/197789
-    return(parsed_url._replace(query=query).geturl())
+def compile_glob(pattern):
+    return re.compile(fnmatch.translate(pattern))
 
 
-@url_cleanup_function
-def misc_query_cleaner(urlstring):
-    """Clean misc fields out of query
-
-    For URLs in email tracking campaigns.
-
-    Woodsmith email tracking URL:
-        https://www.aip.org/fyi/2016/congress-passes-national-defense-authorization-act?dm_i=%5B%271ZJN%2C4OZJ0%2CE29EEG%2CHJY6C%2C1%27%5D
-    Converts to:
-        https://www.aip.org/fyi/2016/congress-passes-national-defense-authorization-act
-    """
-    parsed_url = urllib.parse.urlparse(urlstring)
-    if not parsed_url.query:
-        return None
-    query_params = urllib.parse.parse_qs(parsed_url.query)
-    # Remove elements from dict
-    # kudos: http://stackoverflow.com/a/11277439/197789
-    query_params.pop("dm_i", None)
-    query = urllib.parse.urlencode(query_params, doseq=True)
-    # Create modified parsed_url using _replace()
-    # Kudos: http://stackoverflow.com/a/24201020/197789
-    return(parsed_url._replace(query=query).geturl())
+# Rules applied by apply_rules(), replaced in main() to add user rules
+rules = Rules(DEFAULT_RULES)
 
 
 @url_cleanup_function
-def fb_query_cleaner(urlstring):
-    """Clean misc fields out of query
-
-    Remove "fbclid" query parameters.
-    """
-    parsed_url = urllib.parse.urlparse(urlstring)
-    if not parsed_url.query:
-        return None
-    query_params = urllib.parse.parse_qs(parsed_url.query)
-    # Remove elements from dict
-    # kudos: http://stackoverflow.com/a/11277439/197789
-    query_params.pop("fbclid", None)
-    query = urllib.parse.urlencode(query_params, doseq=True)
-    # Create modified parsed_url using _replace()
-    # Kudos: http://stackoverflow.com/a/24201020/197789
-    return(parsed_url._replace(query=query).geturl())
+def apply_rules(url):
+    """Apply the declarative rules in rules"""
+    rules.apply(url)
 
 
 def get_clipboard():
@@ -155,6 +351,208 @@ def set_clipboard(value):
     p.stdin.write(value.encode('utf8'))
 
 
+class CommandClipboard(object):
+    """Clipboard read and written by running commands
+
+    The clipboard is read on every check, as there is no way to tell if
+    it has changed other than reading it, so with --watch a command is
+    run every --interval seconds even when nothing is copied."""
+
+    def __init__(self, paste, copy):
+        self.paste = paste
+        self.copy = copy
+
+    def changed(self):
+        return True
+
+    def get(self):
+        # Ignore complaints about an empty or non-text clipboard
+        return subprocess.run(self.paste, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              close_fds=True).stdout.decode("utf8", "replace")
+
+    def set(self, value):
+        subprocess.run(self.copy, input=value.encode("utf8"), close_fds=True)
+
+
+class PasteboardClipboard(object):
+    """macOS pasteboard accessed directly with pyobjc
+
+    Checking for changes only compares the pasteboard's change count, so
+    nothing is read or run until something is copied."""
+
+    def __init__(self):
+        self.pasteboard = AppKit.NSPasteboard.generalPasteboard()
+        self.change_count = None
+
+    def changed(self):
+        change_count = self.pasteboard.changeCount()
+        if change_count == self.change_count:
+            return False
+        self.change_count = change_count
+        return True
+
+    def get(self):
+        return self.pasteboard.stringForType_(AppKit.NSPasteboardTypeString) \
+            or ""
+
+    def set(self, value):
+        self.pasteboard.clearContents()
+        self.pasteboard.setString_forType_(value,
+                                           AppKit.NSPasteboardTypeString)
+
+
+class WaylandClipboard(CommandClipboard):
+    """Wayland clipboard, watched with one long-running wl-paste
+
+    wl-paste --watch runs a command each time the clipboard changes,
+    which here copies the contents, followed by a NUL, to a pipe read by
+    a thread."""
+
+    def __init__(self):
+        CommandClipboard.__init__(self, ["wl-paste", "--no-newline"],
+                                  ["wl-copy"])
+        self.value = None
+        self.new_value = threading.Event()
+        self.watcher = subprocess.Popen(
+            ["wl-paste", "--no-newline", "--watch",
+             "sh", "-c", "cat; printf '\\0'"],
+            stdout=subprocess.PIPE, close_fds=True)
+        thread = threading.Thread(target=self.read_values, daemon=True)
+        thread.start()
+
+    def read_values(self):
+        value = b""
+        for block in iter(lambda: self.watcher.stdout.read1(65536), b""):
+            value += block
+            *values, value = value.split(b"\0")
+            if values:
+                self.value = values[-1].decode("utf8", "replace")
+                self.new_value.set()
+
+    def changed(self):
+        if not self.new_value.is_set():
+            return False
+        self.new_value.clear()
+        return True
+
+    def get(self):
+        return self.value or ""
+
+
+class FileClipboard(object):
+    """A file standing in for the clipboard, for testing"""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime_ns = None
+
+    def changed(self):
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime_ns == self.mtime_ns:
+            return False
+        self.mtime_ns = mtime_ns
+        return True
+
+    def get(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def set(self, value):
+        # Replace atomically so a reader never sees a partial value
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(value)
+        os.replace(tmp, self.path)
+
+
+class XclipClipboard(CommandClipboard):
+    """X11 clipboard accessed with xclip, watched with clipnotify
+
+    clipnotify (https://github.com/cdown/clipnotify) exits when the
+    clipboard changes, so if it is installed the clipboard is only read
+    after something is copied. Otherwise it is read on every check, as
+    for CommandClipboard."""
+
+    def __init__(self):
+        CommandClipboard.__init__(
+            self, ["xclip", "-selection", "clipboard", "-out"],
+            ["xclip", "-selection", "clipboard", "-in"])
+        self.notified = None
+        if shutil.which("clipnotify"):
+            self.notified = threading.Event()
+            # Read whatever is in the clipboard when we start
+            self.notified.set()
+            thread = threading.Thread(target=self.notify, daemon=True)
+            thread.start()
+
+    def notify(self):
+        while subprocess.run(["clipnotify"], stderr=subprocess.DEVNULL,
+                             close_fds=True).returncode == 0:
+            self.notified.set()
+
+    def changed(self):
+        if self.notified is None:
+            return True
+        if not self.notified.is_set():
+            return False
+        self.notified.clear()
+        return True
+
+
+# Functions returning each kind of clipboard, by name
+clipboards = {
+    "pbpaste": lambda: CommandClipboard(["pbpaste"], ["pbcopy"]),
+    "xclip": XclipClipboard,
+    "wl-clipboard": WaylandClipboard,
+}
+if AppKit:
+    clipboards["pasteboard"] = PasteboardClipboard
+
+
+def default_clipboard():
+    """Return name of the best clipboard for this system"""
+    if sys.platform == "darwin":
+        return "pasteboard" if AppKit else "pbpaste"
+    if os.environ.get("WAYLAND_DISPLAY"):
+        return "wl-clipboard"
+    return "xclip"
+
+
+def watch_clipboard(clipboard, interval=1.0, debounce=0.5):
+    """Clean URLs copied to clipboard until interrupted
+
+    The clipboard is checked every interval seconds. A URL is only
+    cleaned once the clipboard has held it for debounce seconds, so
+    several quick copies lead to one rewrite. Anything other than a
+    single URL is left alone."""
+    pending = None
+    pending_since = None
+    while True:
+        if clipboard.changed():
+            value = clipboard.get()
+            if value != pending:
+                pending = value
+                pending_since = time.monotonic()
+        if pending is not None and \
+                time.monotonic() - pending_since >= debounce:
+            urlstring = pending.strip()
+            pending = None
+            if urlstring and not any(c.isspace() for c in urlstring):
+                try:
+                    cleaned = clean_url(urlstring)
+                except ValueError:
+                    cleaned = urlstring
+                # Cleaned URLs are unchanged by cleaning, so our own
+                # rewrite won't be rewritten again
+                if cleaned != urlstring:
+                    clipboard.set(cleaned)
+        time.sleep(interval)
+
+
 def parse_url(urlstring):
     """Parse URL and print it
 
@@ -176,14 +574,246 @@ def parse_url(urlstring):
     return(0)
 
 
-def process_url(urlstring):
+def process_url(url):
+    """Run all cleanup functions on url and return resulting string
+
+    url may be a string or a URL instance."""
     global cleanup_functions
+    if not isinstance(url, URL):
+        url = URL(url)
     for func in cleanup_functions:
-        result = func(urlstring)
-        if result is None:
+        func(url)
+    return url.geturl()
+
+
+# Prefix for lines which could not be cleaned in batch mode
+BAD_URL_MARKER = "# Bad url: "
+
+# Input is decoded with errors="surrogateescape", so bytes which aren't
+# valid in the input encoding appear as these lone surrogates
+UNDECODABLE_REGEX = re.compile("[\udc80-\udcff]")
+
+
+@functools.lru_cache(maxsize=CLEAN_URL_CACHE_SIZE)
+def clean_url(urlstring):
+    """Check urlstring is a URL, clean it and return resulting string
+
+    Raises ValueError if urlstring isn't a URL. Results are cached, as
+    the same URLs tend to repeat in logs and mail archives, so
+    clean_url.cache_clear() must be called if the rules change."""
+    # Best I can tell, ValueError is the only exception type possible
+    url = URL(urlstring)
+    # It seems one can feed urlparse anything and it will return a ParseResult
+    # with the value in path and efverything else being an empty string.
+    if not url.scheme:
+        raise ValueError("no scheme")
+    return process_url(url)
+
+
+def clean_lines(lines):
+    """Clean one URL per line, yielding resulting lines in order
+
+    Blank lines are passed through and lines which aren't URLs, or
+    can't be decoded, are passed through prefixed with BAD_URL_MARKER."""
+    for line in lines:
+        urlstring = line.strip()
+        if not urlstring:
+            yield "\n"
+            continue
+        if UNDECODABLE_REGEX.search(urlstring):
+            yield BAD_URL_MARKER + urlstring + "\n"
             continue
-        urlstring = result
-    return urlstring
+        try:
+            yield clean_url(urlstring) + "\n"
+        except ValueError:
+            yield BAD_URL_MARKER + urlstring + "\n"
+
+
+def read_lines(paths, wait=None):
+    """Yield lines from each of paths in turn, '-' being stdin
+
+    Bytes which aren't valid in the locale's encoding are decoded as
+    lone surrogates (errors="surrogateescape").
+
+    Lines are yielded as soon as they are read. If given, wait() is
+    called before reading would block, e.g. to flush output for the
+    lines read so far."""
+    for path in paths:
+        f = sys.stdin.buffer if path == "-" else open(path, "rb")
+        decoder = codecs.getincrementaldecoder(
+            locale.getpreferredencoding(False))(errors="surrogateescape")
+        pending = ""
+        try:
+            while True:
+                if wait and not select.select([f], [], [], 0)[0]:
+                    wait()
+                # Returns what is available, up to 64KB, without waiting
+                # for more
+                data = f.read1(65536)
+                if not data:
+                    break
+                *lines, pending = (pending + decoder.decode(data)).split("\n")
+                for line in lines:
+                    yield line + "\n"
+            pending += decoder.decode(b"", final=True)
+            if pending:
+                yield pending
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+
+def read_chunks(lines, chunk_size=1024 * 1024):
+    """Yield text of lines in chunks of about chunk_size characters"""
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def clean_chunk(chunk):
+    """Clean chunk of lines, returning resulting text and number of lines"""
+    lines = io.StringIO(chunk)
+    result = "".join(clean_lines(lines))
+    return result, chunk.count("\n") + (not chunk.endswith("\n"))
+
+
+# URLs in free text: a scheme followed by anything but whitespace and
+# characters which usually delimit URLs in text, Markdown and HTML.
+TEXT_URL_REGEX = re.compile(r"""\b(?:https?|ftp)://[^\s<>"'`]+""",
+                            re.IGNORECASE)
+
+# Characters which end a sentence or enclose a URL rather than being
+# part of it when they appear at its end.
+TEXT_URL_TRAILING = ".,;:!?)]}*_"
+
+# Whitespace, after which TEXT_URL_REGEX can always start a new match.
+# Other Unicode whitespace also ends URLs, but splitting text only at
+# these is enough.
+TEXT_WHITESPACE = " \t\n\r\f\v"
+
+
+def clean_text_url(match):
+    """Return cleaned version of a URL matched by TEXT_URL_REGEX"""
+    text = match.group(0)
+    end = len(text)
+    while end and text[end - 1] in TEXT_URL_TRAILING:
+        # Keep closing parentheses which are part of the URL, e.g.
+        # https://en.wikipedia.org/wiki/Python_(programming_language)
+        if text[end - 1] == ")" and \
+                text.count("(", 0, end) >= text.count(")", 0, end):
+            break
+        end -= 1
+    urlstring, trailing = text[:end], text[end:]
+    if UNDECODABLE_REGEX.search(urlstring):
+        return text
+    # In HTML, & in attributes is usually escaped
+    escaped = "&amp;" in urlstring
+    if escaped:
+        urlstring = urlstring.replace("&amp;", "&")
+    try:
+        cleaned = clean_url(urlstring)
+    except ValueError:
+        return text
+    if escaped:
+        cleaned = cleaned.replace("&", "&amp;")
+    return cleaned + trailing
+
+
+def clean_text(chunks):
+    """Clean every URL in text, yielding the resulting text
+
+    chunks is an iterable of strings, which may split the text anywhere.
+    As URLs can't contain whitespace, each chunk is cleaned up to its
+    last whitespace character and the rest kept for the next one."""
+    carry = ""
+    for chunk in chunks:
+        text = carry + chunk
+        # carry has no whitespace, so only chunk needs searching
+        end = max(text.rfind(c, len(carry)) for c in TEXT_WHITESPACE) + 1
+        carry = text[end:]
+        yield TEXT_URL_REGEX.sub(clean_text_url, text[:end])
+    yield TEXT_URL_REGEX.sub(clean_text_url, carry)
+
+
+def read_blocks(paths, block_size=64 * 1024):
+    """Yield text from each of paths in turn in blocks of block_size
+
+    Bytes which aren't valid in the locale's encoding are decoded as
+    lone surrogates (errors="surrogateescape")."""
+    for path in paths:
+        f = sys.stdin if path == "-" else open(path,
+                                                errors="surrogateescape")
+        try:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                yield block
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def set_rules(new_rules):
+    """Replace the rules used by apply_rules() (for worker processes)"""
+    global rules
+    rules = new_rules
+    clean_url.cache_clear()
+
+
+def clean_chunks_parallel(chunks, jobs):
+    """Like map(clean_chunk, chunks) but using jobs worker processes
+
+    Results are yielded in the order of chunks, with at most 2 * jobs
+    chunks in memory at once."""
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=set_rules, initargs=(rules,)) as executor:
+        inflight = collections.deque()
+        for chunk in chunks:
+            if len(inflight) >= 2 * jobs:
+                yield inflight.popleft().result()
+            inflight.append(executor.submit(clean_chunk, chunk))
+        while inflight:
+            yield inflight.popleft().result()
+
+
+def batch(paths, output=sys.stdout, jobs=1, stats=False):
+    """Clean URLs from paths, one per line, writing results to output
+
+    If jobs is greater than one, chunks of input are cleaned in that
+    many worker processes. If stats is True, the number of URLs and rate
+    is printed to stderr."""
+    start = time.perf_counter()
+    count = 0
+    try:
+        if jobs > 1:
+            for text, lines in clean_chunks_parallel(
+                    read_chunks(read_lines(paths)), jobs):
+                output.write(text)
+                count += lines
+        else:
+            # Line at a time, flushing whenever we'd wait for input, so
+            # results from a live stream aren't held back
+            for line in clean_lines(read_lines(paths, wait=output.flush)):
+                output.write(line)
+                count += 1
+    finally:
+        output.flush()
+        if stats:
+            elapsed = time.perf_counter() - start
+            print("Cleaned {} URLs in {:.3f}s ({:.0f} URLs/s)".format(
+                count, elapsed, count / elapsed if elapsed else 0),
+                file=sys.stderr)
+    return(0)
 
 
 def main(argv=None):
@@ -204,15 +834,32 @@ def main(argv=None):
         output_func=print,
         readclipboard=False
         )
+    parser.add_argument("-b", "--batch",
+                        action="store_true", default=False,
+                        help="Clean one URL per line of the files given"
+                        " as arguments (default stdin)")
     parser.add_argument("-c", "--clipboard",
                         action="store_const",
                         dest="output_func",
                         const=set_clipboard,
                         help="Put resulting URL in clipboard")
+    parser.add_argument("--clipboard-backend", metavar="NAME",
+                        choices=sorted(clipboards) + ["file"],
+                        default=default_clipboard(),
+                        help="How to access the clipboard with --watch:"
+                        " {} (default {})".format(
+                            ", ".join(sorted(clipboards) + ["file"]),
+                            default_clipboard()))
+    parser.add_argument("--clipboard-file", metavar="PATH",
+                        help="File to use as the clipboard with"
+                        " --clipboard-backend file")
     parser.add_argument("-C", "--readclipboard",
                         action="store_true",
                         dest="readclipboard",
                         help="Read URL from clipboard")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="With --batch, clean URLs using N processes"
+                        " (0 for one per CPU, default 1)")
     parser.add_argument("-o", "--open",
                         action="store_const",
                         dest="output_func",
@@ -226,9 +873,90 @@ def main(argv=None):
                         dest="output_func",
                         const=print,
                         help="Print resulting URL")
+    parser.add_argument("-t", "--text",
+                        action="store_true", default=False,
+                        help="Clean all URLs in the text of the files given"
+                        " as arguments (default stdin)")
+    parser.add_argument("-r", "--rules", metavar="FILE",
+                        action="append", default=[],
+                        help="Read additional rules from FILE")
+    parser.add_argument("-s", "--stats",
+                        action="store_true", default=False,
+                        help="With --batch, print number of URLs cleaned"
+                        " per second to stderr")
+    parser.add_argument("-w", "--watch",
+                        action="store_true", default=False,
+                        help="Keep running, cleaning URLs copied to the"
+                        " clipboard. With the pbpaste backend, and xclip"
+                        " without clipnotify, this runs a command every"
+                        " --interval seconds")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        metavar="SECONDS",
+                        help="With --watch, how often to check the"
+                        " clipboard (default 1.0)")
+    parser.add_argument("--debounce", type=float, default=0.5,
+                        metavar="SECONDS",
+                        help="With --watch, wait until a URL has been in"
+                        " the clipboard this long before cleaning it"
+                        " (default 0.5)")
     parser.add_argument('url', metavar='url', type=str, nargs="*",
                         help='url to parse')
-    args = parser.parse_args()
+    args = parser.parse_args(argv[1:])
+
+    rules_files = args.rules
+    if os.path.exists(DEFAULT_RULES_PATH):
+        rules_files.insert(0, DEFAULT_RULES_PATH)
+    for path in rules_files:
+        try:
+            with open(path) as f:
+                rules.load(f.read())
+        except (OSError, ValueError) as e:
+            print("Error reading rules from {}: {}".format(path, e),
+                  file=sys.stderr)
+            return(1)
+    clean_url.cache_clear()
+
+    if args.watch:
+        if args.clipboard_backend == "file":
+            if not args.clipboard_file:
+                print("--clipboard-file is required with file backend",
+                      file=sys.stderr)
+                return(1)
+            clipboard = FileClipboard(args.clipboard_file)
+        else:
+            clipboard = clipboards[args.clipboard_backend]()
+        try:
+            watch_clipboard(clipboard, interval=args.interval,
+                            debounce=args.debounce)
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            print(e, file=sys.stderr)
+            return(1)
+        return(0)
+
+    if args.text:
+        # Pass through text which isn't valid in the locale's encoding
+        sys.stdin.reconfigure(errors="surrogateescape")
+        sys.stdout.reconfigure(errors="surrogateescape")
+        try:
+            for text in clean_text(read_blocks(args.url or ["-"])):
+                sys.stdout.write(text)
+        except OSError as e:
+            print(e, file=sys.stderr)
+            return(1)
+        return(0)
+
+    if args.batch:
+        # Write undecodable input back out as the bytes it came from
+        sys.stdout.reconfigure(errors="surrogateescape")
+        try:
+            return(batch(args.url or ["-"],
+                         jobs=args.jobs or os.cpu_count() or 1,
+                         stats=args.stats))
+        except OSError as e:
+            print(e, file=sys.stderr)
+            return(1)
 
     if args.readclipboard:
         url = get_clipboard()
@@ -246,19 +974,11 @@ def main(argv=None):
 
     if args.parse:
         return(parse_url(args.url[0]))
-    # Check to make sure url is parsable
     try:
-        results = urllib.parse.urlparse(args.url[0])
+        url = clean_url(args.url[0])
     except ValueError:
-        # Best I can tell, this is the only exception type possible
-        print("Bad url: {}".format(args.url[0]), file=sys.stderr)
-        return(1)
-    # It seems one can feed urlparse anything and it will return a ParseResult
-    # with the value in path and efverything else being an empty string.
-    if not results.scheme:
         print("Bad url: {}".format(args.url[0]), file=sys.stderr)
         return(1)
-    url = process_url(args.url[0])
     args.output_func(url)
     return(0)
 